@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+ benchmarks/batch_image_export_bench.py
+
+-----------------------------------------------------------------------------
+  Copyright (C) 2006-2014 University of Dundee. All rights reserved.
+
+
+  This program is free software; you can redistribute it and/or modify
+  it under the terms of the GNU General Public License as published by
+  the Free Software Foundation; either version 2 of the License, or
+  (at your option) any later version.
+  This program is distributed in the hope that it will be useful,
+  but WITHOUT ANY WARRANTY; without even the implied warranty of
+  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+  GNU General Public License for more details.
+
+  You should have received a copy of the GNU General Public License along
+  with this program; if not, write to the Free Software Foundation, Inc.,
+  51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+------------------------------------------------------------------------------
+
+Measures the throughput of Batch_Image_Export.py without an OMERO server.
+batchImageExport() is run against an in-process stand-in for BlitzGateway
+and ImageWrapper that serves synthetic images, once for each format and
+zoom. Each run is in its own process, so that its peak RSS can be measured.
+
+The OMERO Python libraries must be importable, as for the script itself.
+This file is outside the omero/ directory so that it is not distributed
+with the scripts.
+
+Usage:
+    python benchmarks/batch_image_export_bench.py --size 1024x1024 \\
+        --channels 3 --z 5 --t 2 --formats JPEG,PNG --zooms 50%,100% \\
+        --output results.json
+
+Prints (or writes to --output) JSON with the settings and a result for each
+format and zoom: planes, seconds, planes_per_sec, output_mb, mb_per_sec and
+peak_rss_mb.
+
+@author  OME Team
+@version 5.0
+"""
+
+import json
+import optparse
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "omero", "export_scripts"))
+
+FORMATS = ['JPEG', 'PNG', 'TIFF', 'OME-TIFF']
+ZOOMS = ['25%', '50%', '100%']
+# formats that export the raw pixels, so are not zoomed
+RAW_FORMATS = ['OME-TIFF', 'Chunked NPY']
+
+
+class FakeColor(object):
+
+    def __init__(self, rgb):
+        self.rgb = rgb
+
+    def getRed(self):
+        return self.rgb[0]
+
+    def getGreen(self):
+        return self.rgb[1]
+
+    def getBlue(self):
+        return self.rgb[2]
+
+    def getHtml(self):
+        return "%02X%02X%02X" % self.rgb
+
+
+class FakeChannel(object):
+
+    COLOURS = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0),
+               (255, 0, 255), (0, 255, 255)]
+
+    def __init__(self, index):
+        self.index = index
+
+    def getLabel(self):
+        return "ch%d" % self.index
+
+    def isActive(self):
+        return True
+
+    def getWindowStart(self):
+        return 0
+
+    def getWindowEnd(self):
+        return 4095
+
+    def isInverted(self):
+        return False
+
+    def getColor(self):
+        return FakeColor(self.COLOURS[self.index % len(self.COLOURS)])
+
+
+class FakeValue(object):
+
+    def __init__(self, value):
+        self.value = value
+
+    def getValue(self):
+        return self.value
+
+
+class FakePixelsType(object):
+
+    value = 'uint16'
+
+    def getBitSize(self):
+        return 16
+
+
+class FakeResolution(object):
+
+    def __init__(self, sizeX, sizeY):
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+
+
+class FakeRenderingEngine(object):
+    """
+    Stands in for the RenderingEngine of an ImageWrapper. Planes are rendered
+    from the image's synthetic pixels and JPEG compressed, like the server.
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.level = None
+
+    def requiresPixelsPyramid(self):
+        return False
+
+    def getResolutionLevels(self):
+        return 1
+
+    def getResolutionDescriptions(self):
+        return [FakeResolution(self.image.getSizeX(), self.image.getSizeY())]
+
+    def setResolutionLevel(self, level):
+        self.level = level
+
+    def setCompressionLevel(self, level):
+        pass
+
+    def getChannelFamily(self, index):
+        return FakeValue('linear')
+
+    def getChannelCurveCoefficient(self, index):
+        return 1.0
+
+    def compress(self, rgb):
+        buf = StringIO()
+        Image.fromarray(rgb).save(buf, "JPEG", quality=90)
+        return buf.getvalue()
+
+    def renderCompressed(self, planeDef):
+        rgb = self.image.renderArray(planeDef.z, planeDef.t)
+        step = getattr(planeDef, 'stride', 0) + 1
+        if step > 1:
+            rgb = numpy.ascontiguousarray(rgb[::step, ::step])
+        return self.compress(rgb)
+
+    def renderProjectedCompressed(self, algorithm, t, stepping, start, end):
+        planes = [self.image.renderArray(z, t) for z in range(start, end+1)]
+        return self.compress(numpy.max(planes, axis=0))
+
+    def close(self):
+        pass
+
+
+class FakePixels(object):
+    """
+    Stands in for PixelsWrapper, serving the image's synthetic raw planes.
+    """
+
+    def __init__(self, image):
+        self.image = image
+
+    def getPixelsType(self):
+        return FakePixelsType()
+
+    def getPlanes(self, zctList):
+        for z, c, t in zctList:
+            yield self.image.rawPlane(z, c, t)
+
+    def getTiles(self, zctTileList):
+        for z, c, t, (x, y, w, h) in zctTileList:
+            yield self.image.rawPlane(z, c, t)[y:y+h, x:x+w]
+
+
+class FakeImage(object):
+    """
+    Stands in for ImageWrapper. The raw pixels are noise on a gradient,
+    shifted for each Z, C and T, so that they compress like real images
+    rather than like a blank plane.
+    """
+
+    def __init__(self, imageId, sizeX, sizeY, sizeC, sizeZ, sizeT):
+        self.imageId = imageId
+        self.sizeX = sizeX
+        self.sizeY = sizeY
+        self.sizeC = sizeC
+        self.sizeZ = sizeZ
+        self.sizeT = sizeT
+        self.active = range(sizeC)
+        self.greyscale = False
+        self._re = None
+        random = numpy.random.RandomState(imageId)
+        gradient = numpy.add.outer(numpy.arange(sizeY), numpy.arange(sizeX))
+        self.base = (gradient * 2048 // (sizeX + sizeY) +
+                     random.randint(0, 512, (sizeY, sizeX))).astype('uint16')
+
+    def getId(self):
+        return self.imageId
+
+    def getName(self):
+        return "bench_image_%d.dv" % self.imageId
+
+    def getSizeX(self):
+        return self.sizeX
+
+    def getSizeY(self):
+        return self.sizeY
+
+    def getSizeC(self):
+        return self.sizeC
+
+    def getSizeZ(self):
+        return self.sizeZ
+
+    def getSizeT(self):
+        return self.sizeT
+
+    def getDefaultZ(self):
+        return 0
+
+    def getDefaultT(self):
+        return 0
+
+    def getPixelSizeX(self):
+        return 0.1
+
+    def getPixelSizeY(self):
+        return 0.1
+
+    def getPixelSizeZ(self):
+        return 0.5
+
+    def getChannels(self):
+        return [FakeChannel(c) for c in range(self.sizeC)]
+
+    def getPrimaryPixels(self):
+        return FakePixels(self)
+
+    def isGreyscaleRenderingModel(self):
+        return self.greyscale
+
+    def setActiveChannels(self, channels):
+        self.active = [c - 1 for c in channels]
+
+    def setGreyscaleRenderingModel(self):
+        self.greyscale = True
+
+    def setColorRenderingModel(self):
+        self.greyscale = False
+
+    def _prepareRE(self):
+        return FakeRenderingEngine(self)
+
+    def _prepareRenderingEngine(self):
+        if self._re is None:
+            self._re = FakeRenderingEngine(self)
+        return True
+
+    def listAnnotations(self, ns=None):
+        return []
+
+    def rawPlane(self, z, c, t):
+        shift = (z * 7 + c * 13 + t * 3) % self.sizeX
+        return numpy.roll(self.base, shift, axis=1)
+
+    def renderArray(self, z, t):
+        """
+        Renders an RGB plane of the active channels as a numpy array.
+        """
+        rgb = numpy.zeros((self.sizeY, self.sizeX, 3), numpy.float32)
+        for c in self.active:
+            colour = FakeChannel(c).getColor().rgb
+            if self.greyscale:
+                colour = (255, 255, 255)
+            plane = self.rawPlane(z, c, t).astype(numpy.float32) / 4095
+            for i in range(3):
+                if colour[i]:
+                    rgb[..., i] += plane * colour[i]
+            if self.greyscale:
+                break
+        return numpy.clip(rgb, 0, 255).astype(numpy.uint8)
+
+    def renderImage(self, z, t):
+        return Image.fromarray(self.renderArray(z, t))
+
+    def exportOmeTiff(self, bufsize=0):
+        """
+        Streams the raw pixels, as the server streams the OME-TIFF it has
+        generated.
+        """
+        planes = [(z, c, t) for t in range(self.sizeT)
+                  for c in range(self.sizeC) for z in range(self.sizeZ)]
+        size = len(planes) * self.sizeX * self.sizeY * 2
+
+        def blocks():
+            for z, c, t in planes:
+                data = self.rawPlane(z, c, t).tostring()
+                for i in range(0, len(data), bufsize):
+                    yield data[i:i+bufsize]
+        return size, blocks()
+
+
+class FakeGateway(object):
+    """
+    Stands in for BlitzGateway. Every getObject() call returns a new wrapper,
+    as each worker thread of the export loads its own.
+    """
+
+    def __init__(self, imageCount, sizeX, sizeY, sizeC, sizeZ, sizeT):
+        self.dims = (sizeX, sizeY, sizeC, sizeZ, sizeT)
+        self.imageIds = range(1, imageCount + 1)
+        self.uploaded = []
+
+    def getObject(self, objType, objId):
+        return FakeImage(objId, *self.dims)
+
+    def getObjects(self, objType, ids):
+        return [self.getObject(objType, i) for i in ids]
+
+    def deleteObjects(self, objType, ids):
+        pass
+
+
+def peakRssMb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on Mac OS, KB elsewhere
+        return peak / (1024.0 * 1024)
+    return peak / 1024.0
+
+
+def runCase(options, format, zoom):
+    """
+    Exports the fake images in the current process and returns the
+    measurements as a dict.
+    """
+    import Batch_Image_Export as export
+
+    sizeX, sizeY = [int(s) for s in options.size.split("x")]
+    conn = FakeGateway(options.images, sizeX, sizeY, options.channels,
+                       options.z, options.t)
+
+    def getObjects(conn, params):
+        return conn.getObjects("Image", params["IDs"]), ""
+
+    def createLinkFileAnnotation(conn, path, parent, **kwargs):
+        conn.uploaded.append(os.path.getsize(path))
+        return None, ""
+
+    export.script_utils.getObjects = getObjects
+    export.script_utils.createLinkFileAnnotation = createLinkFileAnnotation
+
+    params = {
+        "Data_Type": "Image",
+        "IDs": conn.imageIds,
+        "Export_Individual_Channels": True,
+        "Individual_Channels_Grey": True,
+        "Export_Merged_Image": True,
+        "Choose_Z_Section": "ALL Z planes",
+        "Choose_T_Section": "ALL T planes",
+        "Zoom": zoom,
+        "Format": format,
+        "Folder_Name": "Batch_Image_Export_bench",
+        "Stream_To_Zip": options.stream,
+        "Reuse_Previous_Export": False,
+        "Parallel_Renders": options.workers,
+        "Render_Locally": options.local,
+    }
+
+    workDir = tempfile.mkdtemp(prefix="batch_image_export_bench")
+    cwd = os.getcwd()
+    os.chdir(workDir)
+    # keep the script's progress messages out of our output
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, "w")
+    try:
+        start = time.time()
+        export.batchImageExport(conn, params)
+        seconds = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(cwd)
+        shutil.rmtree(workDir)
+
+    if format in RAW_FORMATS:
+        planes = options.images * options.channels * options.z * options.t
+    else:
+        planes = len("".join(export.planeLog.blocks()).splitlines())
+    outputMb = sum(conn.uploaded) / (1024.0 * 1024)
+    return {
+        'format': format,
+        'zoom': zoom,
+        'planes': planes,
+        'seconds': round(seconds, 3),
+        'planes_per_sec': round(planes / seconds, 2),
+        'output_mb': round(outputMb, 3),
+        'mb_per_sec': round(outputMb / seconds, 3),
+        'peak_rss_mb': round(peakRssMb(), 1),
+    }
+
+
+def main():
+    parser = optparse.OptionParser(usage=__doc__.split("Usage:")[1].split(
+        "Prints")[0].rstrip())
+    parser.add_option("--size", default="1024x1024",
+                      help="Width x height of each image [%default]")
+    parser.add_option("--channels", type="int", default=3,
+                      help="Channels per image [%default]")
+    parser.add_option("--z", type="int", default=5,
+                      help="Z sections per image [%default]")
+    parser.add_option("--t", type="int", default=2,
+                      help="Time points per image [%default]")
+    parser.add_option("--images", type="int", default=2,
+                      help="Number of images to export [%default]")
+    parser.add_option("--formats", default=",".join(FORMATS),
+                      help="Comma-separated formats [%default]")
+    parser.add_option("--zooms", default=",".join(ZOOMS),
+                      help="Comma-separated zooms [%default]. Not used"
+                      " for OME-TIFF")
+    parser.add_option("--workers", type="int", default=1,
+                      help="Parallel_Renders [%default]")
+    parser.add_option("--stream", action="store_true", default=False,
+                      help="Stream_To_Zip")
+    parser.add_option("--local", action="store_true", default=False,
+                      help="Render_Locally")
+    parser.add_option("--output", help="Write the JSON results to this file")
+    parser.add_option("--case", help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.case:
+        # run one format and zoom, in a child process
+        format, zoom = options.case.split(":")
+        print json.dumps(runCase(options, format, zoom))
+        return
+
+    cases = []
+    for format in options.formats.split(","):
+        zooms = options.zooms.split(",")
+        if format in RAW_FORMATS:
+            zooms = ['100%']
+        for zoom in zooms:
+            cases.append((format, zoom))
+
+    childArgs = ["--size", options.size,
+                 "--channels", str(options.channels),
+                 "--z", str(options.z), "--t", str(options.t),
+                 "--images", str(options.images),
+                 "--workers", str(options.workers)]
+    if options.stream:
+        childArgs.append("--stream")
+    if options.local:
+        childArgs.append("--local")
+    results = []
+    for format, zoom in cases:
+        # check_output() needs Python 2.7
+        child = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__)] + childArgs +
+            ["--case", "%s:%s" % (format, zoom)], stdout=subprocess.PIPE)
+        output = child.communicate()[0]
+        if child.returncode != 0:
+            sys.exit("%s %s failed" % (format, zoom))
+        result = json.loads(output.strip().splitlines()[-1])
+        sys.stderr.write("%(format)s %(zoom)s: %(planes_per_sec)s planes/s,"
+                         " %(mb_per_sec)s MB/s, peak RSS %(peak_rss_mb)s"
+                         " MB\n" % result)
+        results.append(result)
+
+    report = json.dumps({
+        'settings': {'size': options.size, 'channels': options.channels,
+                     'z': options.z, 't': options.t,
+                     'images': options.images, 'workers': options.workers,
+                     'stream': options.stream, 'local': options.local},
+        'results': results}, indent=1, sort_keys=True)
+    if options.output:
+        f = open(options.output, "w")
+        try:
+            f.write(report)
+        finally:
+            f.close()
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
@@ -38,29 +38,110 @@ import omero.scripts as scripts
 from omero.gateway import BlitzGateway
 import omero.util.script_utils as script_utils
 import omero
-from omero.rtypes import rstring, rlong, robject
+from omero.rtypes import rstring, rlong, robject, unwrap
 from omero.constants.namespaces import NSCREATED, NSOMETIFF
+from omero.constants.projection import ProjectionType
 import os
-
-import glob
+import re
+import Queue
+import numpy
+
+import hashlib
+import json
+import multiprocessing
+import tempfile
+import threading
+import time
 import zipfile
+import zlib
+from cStringIO import StringIO
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 try:
     from PIL import Image  # see ticket:2597
 except ImportError:
     import Image
 
-# keep track of log strings.
-logStrings = []
+EXPORT_NS = NSCREATED + "/omero/export_scripts/Batch_Image_Export"
+
+# Choose_Z_Section options: ImageWrapper projection names
+PROJECTIONS = {'Max projection': 'intmax',
+               'Mean projection': 'intmean',
+               'Sum projection': 'intsum'}
+PROJECTION_TYPES = {'intmax': ProjectionType.MAXIMUMINTENSITY,
+                    'intmean': ProjectionType.MEANINTENSITY,
+                    'intsum': ProjectionType.SUMINTENSITY}
+
+
+class SpooledLog(object):
+    """
+    Lines written to a temporary file (in memory up to 1 MB), so that long
+    exports don't keep their logs in memory. Lines can be written from
+    several threads.
+    """
+
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=1024*1024)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return self.file.tell()
+
+    def write(self, line):
+        with self.lock:
+            self.file.write("%s\n" % line)
+
+    def blocks(self, bufsize=1024*1024):
+        """
+        Yields the contents of the log so far in blocks of bufsize bytes.
+        """
+        end = len(self)
+        offset = 0
+        while offset < end:
+            with self.lock:
+                self.file.seek(offset)
+                block = self.file.read(min(bufsize, end - offset))
+                self.file.seek(0, os.SEEK_END)
+            offset += len(block)
+            yield block
+
+
+# Copied to Batch_Image_Export.txt at the end.
+logFile = SpooledLog()
+# one JSON record per exported file, from logPlane(). Copied to
+# Batch_Image_Export_planes.jsonl at the end.
+planeLog = SpooledLog()
 
 
 def log(text):
     """
-    Adds the text to a list of logs. Compiled into text file at the end.
+    Adds the text to the log. Copied into text file at the end.
     """
     print text
-    logStrings.append(str(text))
+    logFile.write(text)
+
+
+def planeRecord(name, imageId, zRange, channel, t):
+    """
+    Starts the log record for an exported file. The timings (in ms) and
+    bytes are filled in as it is rendered and saved, then it is passed to
+    logPlane().
+
+    @param channel:     Channel index, or None for the merged image
+    """
+    return {'name': os.path.basename(name), 'image': imageId,
+            'z': list(zRange), 'c': channel, 't': t, 'render_ms': 0,
+            'resize_ms': 0, 'encode_ms': 0, 'write_ms': 0, 'bytes': 0}
+
+
+def msSince(start):
+    return round((time.time() - start) * 1000, 1)
+
+
+def logPlane(record):
+    planeLog.write(json.dumps(record, sort_keys=True))
 
 
 def compress(target, base):
@@ -71,46 +152,501 @@ def compress(target, base):
                         "folder.zip"
     @param base:        Name of folder that we want to zip up E.g. "folder"
     """
-    zip_file = zipfile.ZipFile(target, 'w')
+    zip_file = ZipExport(target)
     try:
-        files = os.path.join(base, "*")
-        for name in glob.glob(files):
-            zip_file.write(name, os.path.basename(name), zipfile.ZIP_DEFLATED)
+        for dirPath, dirNames, fileNames in os.walk(base):
+            for fileName in sorted(fileNames):
+                name = os.path.join(dirPath, fileName)
+                zip_file.writeFile(os.path.relpath(name, base), name)
 
     finally:
         zip_file.close()
 
 
+def readBlocks(path, bufsize=1024*1024):
+    """
+    Yields the contents of the file in blocks of bufsize bytes.
+    """
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(bufsize)
+            if not block:
+                break
+            yield block
+    finally:
+        f.close()
+
+
+def readSpool(spoolFile, bufsize=1024*1024):
+    """
+    Yields the rest of the open file in blocks of bufsize bytes.
+    """
+    return iter(lambda: spoolFile.read(bufsize), "")
+
+
+def deflateChunk(data):
+    """
+    Raw-deflates the data, ending on a byte boundary without marking the
+    last block, so that chunks deflated separately can be joined into one
+    deflate stream. The stream is ended with DEFLATE_END.
+    """
+    co = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    return co.compress(data) + co.flush(zlib.Z_SYNC_FLUSH)
+
+
+# an empty final block, to end the deflate stream of joined chunks
+DEFLATE_END = zlib.compressobj(
+    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15).flush()
+
+
+class ZipDeflater(object):
+    """
+    Prepares files for a zip: JPEG and PNG files are already compressed, so
+    they are stored as they are. Other files are deflated in chunks of
+    CHUNK_SIZE bytes on several threads, and the chunks joined into one
+    deflate stream. One ZipDeflater can be shared by several zip files.
+    """
+
+    STORED = ('.jpg', '.jpeg', '.png')
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, workers=None):
+        """
+        @param workers:     Number of threads to deflate with. Default is
+                            the number of cores.
+        """
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self.workers = workers
+        self.deflaters = ThreadPool(workers)
+
+    def newEntry(self, name):
+        zinfo = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        if os.path.splitext(name)[1].lower() in self.STORED:
+            zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.external_attr = 0o644 << 16
+        zinfo.file_size = zinfo.compress_size = 0
+        return zinfo
+
+    def deflate(self, blocks):
+        """
+        Deflates the iterable of strings in chunks of CHUNK_SIZE, on the
+        deflate threads. Yields (data, deflated data) in order, keeping up
+        to 2 chunks per thread in hand.
+        """
+        pending = []
+        chunk = []
+        chunkSize = 0
+        for block in blocks:
+            chunk.append(block)
+            chunkSize += len(block)
+            if chunkSize < self.CHUNK_SIZE:
+                continue
+            data = "".join(chunk)
+            chunk = []
+            chunkSize = 0
+            pending.append(
+                (data, self.deflaters.apply_async(deflateChunk, (data,))))
+            if len(pending) >= 2 * self.workers:
+                data, result = pending.pop(0)
+                yield data, result.get()
+        if chunk:
+            data = "".join(chunk)
+            pending.append(
+                (data, self.deflaters.apply_async(deflateChunk, (data,))))
+        for data, result in pending:
+            yield data, result.get()
+        yield "", DEFLATE_END
+
+    def prepare(self, name, data):
+        """
+        Deflates the data (a string) for a file called name, unless it is
+        stored.
+
+        @return:        Tuple of (ZipInfo with the sizes and CRC set,
+                        list of compressed chunks)
+        """
+        zinfo = self.newEntry(name)
+        zinfo.file_size = len(data)
+        zinfo.CRC = zlib.crc32(data) & 0xffffffff
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            chunks = [data]
+        elif len(data) > self.CHUNK_SIZE:
+            size = self.CHUNK_SIZE
+            blocks = (data[i:i+size] for i in range(0, len(data), size))
+            chunks = [c for d, c in self.deflate(blocks)]
+        else:
+            chunks = [deflateChunk(data), DEFLATE_END]
+        zinfo.compress_size = sum([len(c) for c in chunks])
+        return zinfo, chunks
+
+    def spool(self, name, blocks, spoolFile):
+        """
+        Writes the data from an iterable of strings to spoolFile, deflated
+        unless it is stored, keeping only a few chunks in memory.
+
+        @return:        ZipInfo with the sizes and CRC set
+        """
+        zinfo = self.newEntry(name)
+        if zinfo.compress_type == zipfile.ZIP_STORED:
+            chunks = ((block, block) for block in blocks)
+        else:
+            chunks = self.deflate(blocks)
+        crc = 0
+        for data, compressed in chunks:
+            crc = zlib.crc32(data, crc)
+            zinfo.file_size += len(data)
+            zinfo.compress_size += len(compressed)
+            spoolFile.write(compressed)
+        zinfo.CRC = crc & 0xffffffff
+        return zinfo
+
+    def close(self):
+        """
+        Stops the deflate threads once they have finished their chunks.
+        """
+        self.deflaters.close()
+        self.deflaters.join()
+
+
+class ZipExport(object):
+    """
+    Writes exported files straight into an open zip file, so that nothing
+    is saved to the export folder and read back again by compress().
+    Files can be added from several threads, and are stored or deflated
+    by a ZipDeflater.
+    """
+
+    def __init__(self, target, workers=None, deflater=None):
+        """
+        @param target:      Name of the zip file we want to write E.g.
+                            "folder.zip"
+        @param workers:     Number of threads to deflate with. Default is
+                            the number of cores.
+        @param deflater:    ZipDeflater to share with other zip files. It is
+                            not closed with this zip.
+        """
+        self.target = target
+        self.zip_file = zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED,
+                                        allowZip64=True)
+        self.lock = threading.Lock()
+        # names handed out for files that are not written yet
+        self.reserved = set()
+        self.ownDeflater = deflater is None
+        if deflater is None:
+            deflater = ZipDeflater(workers)
+        self.deflater = deflater
+
+    def __len__(self):
+        return len(self.zip_file.filelist)
+
+    def write(self, name, data):
+        """
+        Adds the data (a string) to the zip as a file called name. The data
+        is deflated before waiting for the zip, so that threads writing
+        different files deflate them at the same time.
+        """
+        zinfo, chunks = self.deflater.prepare(name, data)
+        self.writeEntry(zinfo, chunks)
+
+    def writeEntry(self, zinfo, chunks):
+        """
+        Writes the local header, with the sizes and CRC already set in
+        zinfo, and the (compressed) chunks of the file.
+        """
+        with self.lock:
+            fp = self.zip_file.fp
+            zinfo.header_offset = fp.tell()
+            fp.write(zinfo.FileHeader())
+            for c in chunks:
+                fp.write(c)
+            self.addEntry(zinfo)
+
+    def writeFile(self, name, path):
+        """
+        Adds the file at path to the zip as a file called name, without
+        reading it all into memory. Stored files are read twice, to put the
+        CRC in the local header: readers that stream the zip can't find
+        the end of stored data from a data descriptor.
+        """
+        zinfo = self.deflater.newEntry(name)
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            self.writeBlocks(name, readBlocks(path))
+            return
+        crc = 0
+        for block in readBlocks(path):
+            crc = zlib.crc32(block, crc)
+        zinfo.CRC = crc & 0xffffffff
+        zinfo.file_size = zinfo.compress_size = os.path.getsize(path)
+        self.writeEntry(zinfo, readBlocks(path))
+
+    def writeBlocks(self, name, blocks):
+        """
+        Adds the data from an iterable of strings to the zip as a file called
+        name. Blocks are deflated as they arrive into a temporary file, so
+        the whole file is never held in memory, and other files can be
+        written meanwhile. The entry is then copied into the zip with its
+        sizes and CRC in the local header, using Zip64 if it needs to.
+        """
+        spoolFile = tempfile.TemporaryFile()
+        try:
+            zinfo = self.deflater.spool(name, blocks, spoolFile)
+            spoolFile.seek(0)
+            self.writeEntry(zinfo, readSpool(spoolFile))
+        finally:
+            spoolFile.close()
+
+    def addEntry(self, zinfo):
+        # list the file written at zinfo.header_offset. Call with self.lock
+        self.zip_file.filelist.append(zinfo)
+        self.zip_file.NameToInfo[zinfo.filename] = zinfo
+        self.zip_file._didModify = True
+
+    def size(self):
+        """
+        Returns the size of the zip file if it was closed now, including
+        the central directory written by close().
+        """
+        with self.lock:
+            directory = sum([46 + len(zinfo.filename)
+                             for zinfo in self.zip_file.filelist])
+            return self.zip_file.fp.tell() + directory + 22
+
+    def close(self):
+        if self.ownDeflater:
+            self.deflater.close()
+        self.zip_file.close()
+
+
+def uploadExport(conn, path, parent):
+    """
+    Attaches the export zip to the parent and deletes the local copy.
+
+    @return:        Tuple of (file annotation, message)
+    """
+    log("Uploading %s" % path)
+    fileAnnotation, message = script_utils.createLinkFileAnnotation(
+        conn, path, parent, output="Batch export zip", ns=EXPORT_NS,
+        mimetype='application/zip')
+    os.remove(path)
+    return fileAnnotation, message
+
+
+class ZipVolumes(object):
+    """
+    Writes exported files into a series of zip files (volumes) of up to
+    maxSize bytes each: name_part001.zip, name_part002.zip etc. Each volume
+    is closed and uploaded in the background as soon as it is full, while
+    the export carries on with the next one. A file bigger than maxSize gets
+    a volume to itself. If maxSize is None, all files go into name.zip.
+    """
+
+    def __init__(self, conn, name, parent, maxSize, uploader):
+        """
+        @param name:        Name of the zip file(s), without ".zip"
+        @param parent:      Object to attach the zip files to
+        @param maxSize:     Size limit of each volume in bytes, or None
+        @param uploader:    ThreadPool to upload the full volumes with
+        """
+        self.conn = conn
+        self.name = name
+        self.parent = parent
+        self.maxSize = maxSize
+        self.uploader = uploader
+        self.lock = threading.Lock()
+        # names are unique across all volumes
+        self.reserved = set()
+        # file name: name of the volume it was written to
+        self.locations = {}
+        self.volume = None
+        self.volumeCount = 0
+        self.uploads = []
+        # shared by the volumes, so files can be deflated before we know
+        # which volume they go in
+        self.deflater = ZipDeflater()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def getVolume(self, name, size):
+        """
+        Returns the volume to write the file to, finishing the current
+        volume if size bytes won't fit. Call with self.lock held.
+        """
+        # local header and central directory entry for the file
+        size += 76 + 2 * len(name)
+        if (self.volume is not None and self.maxSize is not None and
+                len(self.volume) > 0 and
+                self.volume.size() + size > self.maxSize):
+            self.finishVolume()
+        if self.volume is None:
+            self.volumeCount += 1
+            if self.maxSize is None:
+                target = "%s.zip" % self.name
+            else:
+                target = "%s_part%03d.zip" % (self.name, self.volumeCount)
+            self.volume = ZipExport(target, deflater=self.deflater)
+        return self.volume
+
+    def finishVolume(self):
+        volume = self.volume
+        self.volume = None
+        volume.close()
+        self.uploads.append(self.uploader.apply_async(
+            uploadExport, (self.conn, volume.target, self.parent)))
+
+    def write(self, name, data):
+        # deflate before taking the lock, and pick the volume by the
+        # compressed size
+        zinfo, chunks = self.deflater.prepare(name, data)
+        with self.lock:
+            volume = self.getVolume(name, zinfo.compress_size)
+            volume.writeEntry(zinfo, chunks)
+            self.locations[name] = volume.target
+
+    def writeBlocks(self, name, blocks):
+        # deflate into a temporary file first, to pick the volume by the
+        # compressed size
+        spoolFile = tempfile.TemporaryFile()
+        try:
+            zinfo = self.deflater.spool(name, blocks, spoolFile)
+            spoolFile.seek(0)
+            with self.lock:
+                volume = self.getVolume(name, zinfo.compress_size)
+                volume.writeEntry(zinfo, readSpool(spoolFile))
+                self.locations[name] = volume.target
+        finally:
+            spoolFile.close()
+
+    def close(self):
+        """
+        Finishes the last volume and waits for all the uploads.
+
+        @return:        List of (file annotation, message) for the volumes
+        """
+        with self.lock:
+            if self.volume is not None:
+                self.finishVolume()
+        self.deflater.close()
+        return [upload.get() for upload in self.uploads]
+
+
+def getExtension(format):
+    """
+    Returns the (file extension, PIL format) used for saving planes in the
+    chosen export format.
+    """
+    if format == "PNG":
+        return "png", "PNG"
+    elif format == 'TIFF':
+        return "tiff", "TIFF"
+    return "jpg", "JPEG"
+
+
+def writeFile(name, data, archive=None):
+    """
+    Writes the data (a string) to a file on disk, or to the archive if given.
+    """
+    if archive is not None:
+        archive.write(name, data)
+        return
+    f = open(name, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def saveImage(image, name, pilFormat, archive=None, record=None):
+    """
+    Encodes the PIL image and writes it to disk, or to the archive if given.
+
+    @param record:      Optional record from planeRecord(), for the encode
+                        and write times and the bytes written
+    """
+    start = time.time()
+    buf = StringIO()
+    image.save(buf, pilFormat)
+    data = buf.getvalue()
+    encoded = time.time()
+    writeFile(name, data, archive)
+    if record is not None:
+        record['encode_ms'] = round((encoded - start) * 1000, 1)
+        record['write_ms'] = msSince(encoded)
+        record['bytes'] = len(data)
+
+
+def planeBytes(renderSize, size=None):
+    """
+    Estimates the memory used by an RGB plane rendered at renderSize (and
+    its copy resized to size, if given) until it is written.
+    """
+    nbytes = renderSize[0] * renderSize[1] * 3
+    if size is not None:
+        nbytes += size[0] * size[1] * 3
+    return nbytes
+
+
 def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
-              greyscale=False, zoomPercent=None, folder_name=None):
+              greyscale=False, zoomPercent=None, folder_name=None,
+              imgName=None, archive=None, tileSize=None, manifest=None,
+              settings=None, pipeline=None):
     """
-    Renders and saves an image to disk.
+    Renders and saves an image to disk, or to the archive if given.
 
     @param renderingEngine: Rendering Engine should already be initialised wi
                             with the correct pixels etc
     @param imgName:         The name or path to save to disk, with extension
                             E.g. imgDir/image01_DAPI_T01_Z01.png
+                            If None, a name is chosen with makeImageName()
     @param zRange:          Tuple of (zIndex,) OR (zStart, zStop) for
                             projection
+    @param projectZ:        Projection to use over zRange: 'intmax',
+                            'intmean' or 'intsum'. False for no projection.
     @param t:               T index
     @param channel:         Active channel index. If None, use current
                             rendering settings
     @param greyscale:       If true, all visible channels will be
                             greyscale
     @param zoomPercent:     Resize image by this percent if specified.
+    @param archive:         Optional ZipExport. If given, the image is
+                            encoded in memory and written into the zip
+    @param tileSize:        If specified, the plane is saved as a grid of
+                            tiles of this size. Used for 'Big' images.
+    @param manifest:        Optional ExportManifest. The saved files are
+                            recorded, and if the previous export has this
+                            plane with the same settings it is copied
+                            instead of rendered.
+    @param settings:        Rendering settings of the image, from
+                            getRenderingSettings(). Needed with manifest.
+    @param pipeline:        Optional ExportPipeline to resize, encode and
+                            write the rendered plane.
     """
 
     originalName = image.getName()
-    log("")
-    log("savePlane..")
-    # log("originalName %s" % originalName)
-    # log("format %s" % format)
-    log("channel: %s" % cName)
-    log("z: %s" % zRange)
-    log("t: %s" % t)
-    # log("channel %s" % channel)
-    # log("greyscale %s" % greyscale)
-    # log("zoomPercent %s" % zoomPercent)
+    # single log entry, so that planes saved concurrently don't interleave
+    log("\nsavePlane..\nchannel: %s\nz: %s\nt: %s" % (cName, zRange, t))
+
+    extension, pilFormat = getExtension(format)
+    if imgName is None:
+        reserved = None
+        if archive is not None:
+            reserved = archive.reserved
+        elif pipeline is not None:
+            reserved = pipeline.reserved
+        imgName = makeImageName(
+            originalName, cName, zRange, t, extension, folder_name, reserved)
+
+    fingerprint = None
+    if manifest is not None:
+        fingerprint = planeFingerprint(
+            settings, zRange, t, channel, greyscale, projectZ, format,
+            zoomPercent, tileSize)
+        if manifest.copyForward(fingerprint, imgName, archive):
+            log("Copied from previous export: %s" % imgName)
+            return
 
     # if channel == None: use current rendering settings
     if channel is not None:
@@ -119,40 +655,622 @@ def savePlane(image, format, cName, zRange, projectZ, t=0, channel=None,
             image.setGreyscaleRenderingModel()
         else:
             image.setColorRenderingModel()
-    if projectZ:
-        # imageWrapper only supports projection of full Z range (can't
-        # specify)
-        image.setProjection('intmax')
-
-    # All Z and T indices in this script are 1-based, but this method uses
-    # 0-based.
-    plane = image.renderImage(zRange[0]-1, t-1)
+
+    record = planeRecord(imgName, image.getId(), zRange, channel, t)
+    if tileSize:
+        tiles = saveTiles(image, imgName, zRange, t, zoomPercent, tileSize,
+                          pilFormat, archive, record)
+        if manifest is not None:
+            for tileName, row, col in tiles:
+                manifest.add(tileName, image.getId(), zRange, channel, t,
+                             zoomPercent, fingerprint, (row, col), archive)
+        return
+
+    size = None
     if zoomPercent:
-        w, h = plane.size
         fraction = (float(zoomPercent) / 100)
-        plane = plane.resize((w * fraction, h * fraction), Image.ANTIALIAS)
+        size = (int(image.getSizeX() * fraction),
+                int(image.getSizeY() * fraction))
+
+    def saved():
+        if manifest is not None:
+            manifest.add(imgName, image.getId(), zRange, channel, t,
+                         zoomPercent, fingerprint, archive=archive)
+
+    nbytes = 0
+    if pipeline is not None:
+        nbytes = planeBytes((image.getSizeX(), image.getSizeY()), size)
+        pipeline.reserve(nbytes)
+    start = time.time()
+    try:
+        # All Z and T indices in this script are 1-based, but this method
+        # uses 0-based.
+        if projectZ:
+            plane = renderProjection(image, projectZ, zRange, t)
+        elif zoomPercent and zoomPercent < 100:
+            plane = renderDownsampled(image, zRange[0]-1, t-1, zoomPercent)
+        else:
+            plane = image.renderImage(zRange[0]-1, t-1)
+    except Exception:
+        if pipeline is not None:
+            pipeline.release(nbytes)
+        raise
+
+    record['render_ms'] = msSince(start)
+
+    log("Saving image: %s" % imgName)
+    if pipeline is not None:
+        pipeline.save(plane, size, imgName, pilFormat, archive, nbytes, saved,
+                      record)
+        return
+    start = time.time()
+    # the plane may already be (nearly) downsampled by the server
+    if size is not None and plane.size != size:
+        plane = plane.resize(size, Image.ANTIALIAS)
+    record['resize_ms'] = msSince(start)
+    saveImage(plane, imgName, pilFormat, archive, record)
+    saved()
+    logPlane(record)
 
-    if format == "PNG":
-        imgName = makeImageName(
-            originalName, cName, zRange, t, "png", folder_name)
-        log("Saving image: %s" % imgName)
-        plane.save(imgName, "PNG")
-    elif format == 'TIFF':
-        imgName = makeImageName(
-            originalName, cName, zRange, t, "tiff", folder_name)
-        log("Saving image: %s" % imgName)
-        plane.save(imgName, 'TIFF')
+
+def renderDownsampled(image, z, t, zoomPercent):
+    """
+    Renders a plane for a zoom below 100%, letting the server do most of the
+    downsampling so that fewer pixels are rendered and transferred. Uses the
+    nearest resolution level if the image has them, otherwise the server
+    only renders every nth pixel (PlaneDef stride). The caller resizes the
+    result to the exact size.
+
+    @param z:               Z index, 0-based
+    @param t:               T index, 0-based
+    @return:                PIL Image
+    """
+    image._prepareRenderingEngine()
+    level, sizeX, sizeY = getResolutionLevel(image, zoomPercent)
+    planeDef = omero.romio.PlaneDef()
+    planeDef.z = long(z)
+    planeDef.t = long(t)
+    if sizeX < image.getSizeX():
+        image._re.setResolutionLevel(level)
     else:
-        imgName = makeImageName(
-            originalName, cName, zRange, t, "jpg", folder_name)
+        planeDef.stride = max(0, int(100 / zoomPercent) - 1)
+    image._re.setCompressionLevel(0.9)
+    return Image.open(StringIO(image._re.renderCompressed(planeDef)))
+
+
+def renderProjection(image, projectZ, zRange, t):
+    """
+    Renders a projection of just the planes in zRange. The projection is
+    done on the server, so only the projected image is transferred.
+
+    @param projectZ:        'intmax', 'intmean' or 'intsum'
+    @param zRange:          Tuple of (zIndex,) OR (zStart, zStop) 1-based,
+                            zStop not included
+    @param t:               T index, 1-based
+    @return:                PIL Image
+    """
+    image._prepareRenderingEngine()
+    start = zRange[0] - 1
+    end = start
+    if len(zRange) > 1:
+        end = zRange[1] - 2
+    image._re.setCompressionLevel(0.9)
+    projection = image._re.renderProjectedCompressed(
+        PROJECTION_TYPES[projectZ], t-1, 1, start, end)
+    return Image.open(StringIO(projection))
+
+
+def isReverseIntensity(channel):
+    """
+    Returns True if the channel is rendered with reversed intensity. Older
+    gateways call this isReverseIntensity(), newer ones isInverted().
+    """
+    for method in ('isInverted', 'isReverseIntensity'):
+        if hasattr(channel, method):
+            return bool(getattr(channel, method)())
+    return False
+
+
+def getRenderingSettings(image):
+    """
+    Returns the rendering settings of the image as a dict that can be
+    written to JSON, for working out whether planes need rendering again.
+    """
+    image._prepareRenderingEngine()
+    channels = []
+    for i, ch in enumerate(image.getChannels()):
+        channels.append([ch.isActive(), ch.getWindowStart(),
+                         ch.getWindowEnd(), ch.getColor().getHtml(),
+                         unwrap(image._re.getChannelFamily(i).getValue()),
+                         image._re.getChannelCurveCoefficient(i),
+                         isReverseIntensity(ch)])
+    return {'image': image.getId(),
+            'greyscale': image.isGreyscaleRenderingModel(),
+            'channels': channels}
+
+
+def planeFingerprint(settings, zRange, t, channel, greyscale, projectZ,
+                     format, zoomPercent, tileSize, local=False):
+    """
+    Returns a hash of everything that affects how a plane is exported.
+    Split channels only depend on the settings of their own channel.
+    """
+    if channel is not None:
+        settings = {'image': settings['image'],
+                    'channel': settings['channels'][channel]}
+    key = [settings, list(zRange), t, channel, greyscale, projectZ, format,
+           zoomPercent, tileSize]
+    if local:
+        # rendered by saveLocalPlanes(), not by the server
+        key.append('local')
+    return hashlib.sha1(json.dumps(key, sort_keys=True)).hexdigest()
+
+
+def getLinearRendering(image):
+    """
+    Returns the rendering settings needed to render the image locally with
+    renderChannels(), or None if any channel doesn't use a linear mapping
+    or has reversed intensity.
+
+    @return:        Dict with 'greyscale' (rendering model) and 'channels':
+                    a list of (active, windowStart, windowEnd, (r, g, b))
+    """
+    image._prepareRenderingEngine()
+    channels = []
+    for i, ch in enumerate(image.getChannels()):
+        if unwrap(image._re.getChannelFamily(i).getValue()) != 'linear':
+            return None
+        if isReverseIntensity(ch):
+            return None
+        colour = ch.getColor()
+        channels.append((ch.isActive(), ch.getWindowStart(),
+                         ch.getWindowEnd(), (colour.getRed(),
+                                             colour.getGreen(),
+                                             colour.getBlue())))
+    return {'greyscale': image.isGreyscaleRenderingModel(),
+            'channels': channels}
+
+
+def getRawPlanes(pixels, zRange, t, channels, projectZ):
+    """
+    Fetches the raw planes for the channels at this Z (or projected over the
+    Z range) and T. Each plane is only fetched once, and projections are
+    accumulated a plane at a time.
+
+    @param pixels:      PixelsWrapper
+    @param zRange:      Tuple of (zIndex,) OR (zStart, zStop) 1-based
+    @param channels:    List of channel indices
+    @param projectZ:    'intmax', 'intmean', 'intsum' or False
+    @return:            Dict of channel index: 2D numpy array
+    """
+    zIndexes = [zRange[0]]
+    if projectZ and len(zRange) > 1:
+        zIndexes = range(zRange[0], zRange[1])
+    zctList = [(z-1, c, t-1) for c in channels for z in zIndexes]
+    planes = pixels.getPlanes(zctList)
+    raw = {}
+    for c in channels:
+        plane = None
+        for z in zIndexes:
+            p = planes.next()
+            if plane is None:
+                plane = p
+                if projectZ in ('intmean', 'intsum'):
+                    plane = plane.astype(numpy.float64)
+            elif projectZ == 'intmax':
+                numpy.maximum(plane, p, plane)
+            else:
+                plane += p
+        if projectZ == 'intmean':
+            plane /= len(zIndexes)
+        elif projectZ == 'intsum' and p.dtype.kind in 'iu':
+            # like the server, clip the sum to the range of the pixel type
+            numpy.minimum(plane, numpy.iinfo(p.dtype).max, plane)
+        raw[c] = plane
+    return raw
+
+
+def renderChannels(raw, channels, rendering, sizeX, sizeY):
+    """
+    Renders raw planes with linear rendering settings: each channel's window
+    is mapped onto 0-255 in the channel's colour, and channels are added.
+
+    @param raw:         Dict of channel index: 2D numpy array
+    @param channels:    List of (channel index, (r, g, b))
+    @param rendering:   Rendering settings from getLinearRendering()
+    @param sizeX:       Width of the image, for a black plane if no
+                        channels are active
+    @param sizeY:       Height of the image
+    @return:            PIL RGB Image
+    """
+    rgb = None
+    for c, colour in channels:
+        active, start, end, _ = rendering['channels'][c]
+        value = raw[c].astype(numpy.float32)
+        value -= start
+        value /= (end - start) or 1
+        numpy.clip(value, 0, 1, value)
+        if rgb is None:
+            rgb = numpy.zeros(value.shape + (3,), numpy.float32)
+        rgb += value[..., numpy.newaxis] * numpy.array(colour, numpy.float32)
+    if rgb is None:
+        # no active channels - black
+        rgb = numpy.zeros((sizeY, sizeX, 3), numpy.float32)
+    numpy.clip(rgb, 0, 255, rgb)
+    return Image.fromarray(rgb.astype(numpy.uint8), 'RGB')
+
+
+def saveLocalPlanes(image, pixels, rendering, zRange, t, planes, format,
+                    projectZ, zoomPercent, archive=None, manifest=None,
+                    settings=None, pipeline=None):
+    """
+    Saves the merged and individual channel images for one Z (or Z range)
+    and T, rendered locally from one fetch of the raw planes, instead of
+    asking the server to render each image.
+
+    @param pixels:      PixelsWrapper of the image
+    @param rendering:   Rendering settings from getLinearRendering()
+    @param planes:      List of (imgName, channel, greyscale) to save.
+                        Channel None is the merged image
+    @param pipeline:    Optional ExportPipeline to resize, encode and write
+                        the rendered planes.
+    """
+    pilFormat = getExtension(format)[1]
+    white = (255, 255, 255)
+    active = [c for c, ch in enumerate(rendering['channels']) if ch[0]]
+    if rendering['greyscale']:
+        # greyscale rendering model only shows the first active channel
+        active = active[:1]
+
+    todo = []
+    for imgName, c, gScale in planes:
+        fingerprint = None
+        if manifest is not None:
+            fingerprint = planeFingerprint(
+                settings, zRange, t, c, gScale, projectZ, format,
+                zoomPercent, None, local=True)
+            if manifest.copyForward(fingerprint, imgName, archive):
+                log("Copied from previous export: %s" % imgName)
+                continue
+        todo.append((imgName, c, gScale, fingerprint))
+    if not todo:
+        return
+
+    needed = set()
+    for imgName, c, gScale, fingerprint in todo:
+        needed.update(active if c is None else [c])
+    start = time.time()
+    raw = getRawPlanes(pixels, zRange, t, sorted(needed), projectZ)
+    # the raw planes are fetched once for all the images of this Z and T,
+    # so the time is only logged with the first one
+    fetchMs = msSince(start)
+
+    for imgName, c, gScale, fingerprint in todo:
+        if c is None:
+            if rendering['greyscale']:
+                channels = [(i, white) for i in active]
+            else:
+                channels = [(i, rendering['channels'][i][3]) for i in active]
+        else:
+            channels = [(c, white if gScale else rendering['channels'][c][3])]
+        fullSize = (image.getSizeX(), image.getSizeY())
+        size = None
+        if zoomPercent:
+            fraction = (float(zoomPercent) / 100)
+            size = (int(fullSize[0] * fraction), int(fullSize[1] * fraction))
+
+        def saved(imgName=imgName, c=c, fingerprint=fingerprint):
+            if manifest is not None:
+                manifest.add(imgName, image.getId(), zRange, c, t,
+                             zoomPercent, fingerprint, archive=archive)
+
+        nbytes = 0
+        if pipeline is not None:
+            nbytes = planeBytes(fullSize, size)
+            pipeline.reserve(nbytes)
+        record = planeRecord(imgName, image.getId(), zRange, c, t)
+        record['fetch_ms'] = fetchMs
+        fetchMs = 0
+        start = time.time()
+        try:
+            plane = renderChannels(raw, channels, rendering, *fullSize)
+        except Exception:
+            if pipeline is not None:
+                pipeline.release(nbytes)
+            raise
+        record['render_ms'] = msSince(start)
         log("Saving image: %s" % imgName)
-        plane.save(imgName)
+        if pipeline is not None:
+            pipeline.save(plane, size, imgName, pilFormat, archive, nbytes,
+                          saved, record)
+            continue
+        start = time.time()
+        if size is not None:
+            plane = plane.resize(size, Image.ANTIALIAS)
+        record['resize_ms'] = msSince(start)
+        saveImage(plane, imgName, pilFormat, archive, record)
+        saved()
+        logPlane(record)
 
 
-def makeImageName(originalName, cName, zRange, t, extension, folder_name):
+class ExportManifest(object):
+    """
+    Records the image, Z/C/T, zoom and rendering settings fingerprint of
+    every exported file. The manifest is saved with the export so that a
+    later export to the same folder can copy the planes that haven't
+    changed from the previous zip, instead of rendering them again.
+    When the export is split into volumes, the manifest is saved in one of
+    them and records which volume each file is in.
+    """
+
+    FILENAME = "Batch_Image_Export_manifest.json"
+
+    def __init__(self):
+        self.entries = []
+        # (archive name, file name) of the files in entries
+        self.names = set()
+        self.lock = threading.Lock()
+        # zip name: ZipFile of the previous export
+        self.previousZips = {}
+        # fingerprint: list of entries in the previous export
+        self.previous = {}
+
+    def loadPrevious(self, paths):
+        """
+        Loads the manifest of a previous export from its zip files. If more
+        than one zip has a manifest, the first one wins.
+
+        @param paths:   List of (zip name, local path), newest first
+        @return:        Number of files listed in the previous manifest
+        """
+        for zipName, path in paths:
+            self.previousZips[zipName] = zipfile.ZipFile(path)
+        for zipName, path in paths:
+            zip_file = self.previousZips[zipName]
+            if self.FILENAME not in zip_file.namelist():
+                continue
+            entries = json.loads(zip_file.read(self.FILENAME))['files']
+            for entry in entries:
+                # files without a volume are in the zip with the manifest
+                entry.setdefault('volume', zipName)
+                if entry['volume'] in self.previousZips:
+                    self.previous.setdefault(entry['fingerprint'],
+                                             []).append(entry)
+            return len(entries)
+        return 0
+
+    def fileKey(self, name, archive):
+        # file names are only unique within each archive
+        return (getattr(archive, 'name', None), os.path.basename(name))
+
+    def add(self, name, imageId, zRange, channel, t, zoomPercent,
+            fingerprint, tile=None, archive=None):
+        entry = {'name': os.path.basename(name), 'image': imageId,
+                 'z': list(zRange), 'c': channel, 't': t,
+                 'zoom': zoomPercent, 'fingerprint': fingerprint}
+        if tile is not None:
+            entry['tile'] = list(tile)
+        if isinstance(archive, ZipVolumes):
+            entry['volume'] = archive.locations[name]
+        key = self.fileKey(name, archive)
+        with self.lock:
+            if key in self.names:
+                return
+            self.names.add(key)
+            self.entries.append(entry)
+
+    def copyForward(self, fingerprint, imgName, archive=None):
+        """
+        Copies the files saved for this fingerprint by the previous export,
+        renaming them for imgName: one file for the plane, or one for each
+        tile of it. Files from the same zip as archive are preferred.
+
+        @return:        True if the plane was copied, False if it needs
+                        rendering.
+        """
+        previous = self.previous.get(fingerprint)
+        if not previous:
+            return False
+        if isinstance(archive, ZipVolumes):
+            volume = re.compile(r"^%s(_part\d{3})?\.zip$"
+                                % re.escape(archive.name))
+            previous = ([e for e in previous if volume.match(e['volume'])] +
+                        [e for e in previous
+                         if not volume.match(e['volume'])])
+        # several planes may have had the same fingerprint
+        tiles = {}
+        for entry in previous:
+            tile = entry.get('tile')
+            if tile is not None:
+                tile = tuple(tile)
+            tiles.setdefault(tile, entry)
+        name, extension = imgName.rsplit(".", 1)
+        for tile, entry in sorted(tiles.items()):
+            newName = imgName
+            if tile is not None:
+                newName = "%s_tile_%03d_%03d.%s" % (name, tile[0], tile[1],
+                                                    extension)
+            # ZipFile can't be read from several threads at once
+            with self.lock:
+                if self.fileKey(newName, archive) in self.names:
+                    continue
+                data = self.previousZips[entry['volume']].read(entry['name'])
+            start = time.time()
+            writeFile(newName, data, archive)
+            record = planeRecord(newName, entry['image'], entry['z'],
+                                 entry['c'], entry['t'])
+            record.update(write_ms=msSince(start), bytes=len(data),
+                          copied=True)
+            if tile is not None:
+                record['tile'] = list(tile)
+            logPlane(record)
+            self.add(newName, entry['image'], entry['z'], entry['c'],
+                     entry['t'], entry['zoom'], fingerprint, tile, archive)
+        return True
+
+    def toJson(self):
+        entries = sorted(self.entries, key=lambda e: e['name'])
+        return json.dumps({'files': entries}, indent=1, sort_keys=True)
+
+    def close(self):
+        for zip_file in self.previousZips.values():
+            zip_file.close()
+
+
+def getDatasetZipName(dataset):
+    """
+    Returns the dataset name as it is used in the name of its zip file.
+    """
+    return re.sub(r"[^\w.-]", "_", dataset.getName())
+
+
+def findPreviousExport(conn, parents, folder_name, namespace,
+                       datasetNames=()):
+    """
+    Downloads the zip files of the most recent previous export to this
+    folder name that were attached to the parents: folder_name.zip or its
+    volumes E.g. folder_name_part001.zip, and the same for each dataset
+    E.g. folder_name_Dataset.zip or folder_name_Dataset_part001.zip
+
+    @param datasetNames:    Names of the datasets that get a zip each, as
+                            given by getDatasetZipName()
+    @return:        List of (zip name, local path), newest first
+    """
+    base = re.escape(folder_name)
+    if datasetNames:
+        base += r"(_(%s)(\(\d+\))?)?" % "|".join(
+            [re.escape(n) for n in datasetNames])
+    zipName = re.compile(r"^(%s)(_part\d{3})?\.zip$" % base)
+    # zip name without volume number: {zip name: newest annotation}
+    exports = {}
+    for parent in parents:
+        for ann in parent.listAnnotations(ns=namespace):
+            name = ann.getFileName()
+            match = name is not None and zipName.match(name)
+            if not match:
+                continue
+            zips = exports.setdefault(match.group(1), {})
+            if name not in zips or ann.getId() > zips[name].getId():
+                zips[name] = ann
+    previous = {}
+    for prefix, zips in exports.items():
+        # each export starts again from the zip or its first volume, so
+        # older volumes are left over from earlier exports
+        firsts = [zips[n].getId() for n in ("%s.zip" % prefix,
+                                            "%s_part001.zip" % prefix)
+                  if n in zips]
+        newest = max(firsts or [0])
+        for name, ann in zips.items():
+            if ann.getId() >= newest:
+                previous[name] = ann
+    paths = []
+    for name, ann in sorted(previous.items(), key=lambda a: -a[1].getId()):
+        path = "previous_%s" % name
+        log("Downloading previous export: %s (File Annotation ID: %s)"
+            % (name, ann.getId()))
+        f = open(path, "wb")
+        try:
+            for chunk in ann.getFileInChunks():
+                f.write(chunk)
+        finally:
+            f.close()
+        paths.append((name, path))
+    return paths
+
+
+def getResolutionLevel(image, zoomPercent):
+    """
+    Picks the smallest resolution level of a 'Big' image that is still at
+    least as big as the zoomed image, so we render as few pixels as possible.
+
+    @param image:           ImageWrapper with rendering engine prepared
+    @param zoomPercent:     The zoom we want to export at. None is 100%
+    @return:                Tuple of (level, sizeX, sizeY) where level is the
+                            rendering engine resolution level
+    """
+    descriptions = image._re.getResolutionDescriptions()
+    fraction = 1.0
+    if zoomPercent:
+        fraction = float(zoomPercent) / 100
+    # descriptions are ordered from full size down, but resolution levels
+    # are numbered from the smallest up.
+    best = 0
+    for i, d in enumerate(descriptions):
+        if d.sizeX >= descriptions[0].sizeX * fraction:
+            best = i
+    level = image._re.getResolutionLevels() - 1 - best
+    return level, descriptions[best].sizeX, descriptions[best].sizeY
+
+
+def saveTiles(image, imgName, zRange, t, zoomPercent, tileSize, pilFormat,
+              archive=None, record=None):
+    """
+    Saves a plane of a 'Big' image as a grid of tiles, rendering one region
+    at a time so that the whole plane is never held in memory.
+    Tiles are named after the plane, with the row and column of the tile
+    E.g. myImage_DAPI_z01_t01_tile_002_005.png
+
+    @param image:           ImageWrapper with the channels set up
+    @param imgName:         Name of the plane, with extension
+    @param tileSize:        Width and height of the tiles, before zooming
+    @param record:          Optional record from planeRecord(). A copy is
+                            logged for each tile.
+    @return:                List of (name, row, column) for the saved tiles
+    """
+    image._prepareRenderingEngine()
+    re = image._re
+    level, sizeX, sizeY = getResolutionLevel(image, zoomPercent)
+    re.setResolutionLevel(level)
+    re.setCompressionLevel(0.9)
+    zoom = 1.0
+    if zoomPercent:
+        zoom = float(zoomPercent) / 100
+    # scale to apply to each tile after rendering at this level
+    fraction = zoom * image.getSizeX() / sizeX
+    log("Saving tiles of %s (resolution level %s: %s x %s)"
+        % (imgName, level, sizeX, sizeY))
+
+    name, extension = imgName.rsplit(".", 1)
+    tiles = []
+    planeDef = omero.romio.PlaneDef()
+    planeDef.z = long(zRange[0]-1)
+    planeDef.t = long(t-1)
+    for row, y in enumerate(range(0, sizeY, tileSize)):
+        for col, x in enumerate(range(0, sizeX, tileSize)):
+            regionDef = omero.romio.RegionDef()
+            regionDef.x = x
+            regionDef.y = y
+            regionDef.width = min(tileSize, sizeX - x)
+            regionDef.height = min(tileSize, sizeY - y)
+            planeDef.region = regionDef
+            tileName = "%s_tile_%03d_%03d.%s" % (name, row, col, extension)
+            tileRecord = dict(record or {}, name=os.path.basename(tileName),
+                              tile=[row, col])
+            start = time.time()
+            tile = Image.open(StringIO(re.renderCompressed(planeDef)))
+            tileRecord['render_ms'] = msSince(start)
+            start = time.time()
+            if fraction != 1:
+                w, h = tile.size
+                tile = tile.resize((max(1, int(round(w * fraction))),
+                                    max(1, int(round(h * fraction)))),
+                                   Image.ANTIALIAS)
+            tileRecord['resize_ms'] = msSince(start)
+            saveImage(tile, tileName, pilFormat, archive, tileRecord)
+            if record is not None:
+                logPlane(tileRecord)
+            tiles.append((tileName, row, col))
+    return tiles
+
+
+def makeImageName(originalName, cName, zRange, t, extension, folder_name,
+                  reserved=None):
     """
     Produces the name for the saved image.
     E.g. imported/myImage.dv -> myImage_DAPI_z13_t01.png
+
+    @param reserved:    Optional set of names already handed out for planes
+                        that may not be on disk yet. The new name is added.
     """
     name = os.path.basename(originalName)
     # name = name.rsplit(".",1)[0]  # remove extension
@@ -163,34 +1281,316 @@ def makeImageName(originalName, cName, zRange, t, extension, folder_name):
     imgName = "%s_%s_z%s_t%02d.%s" % (name, cName, z, t, extension)
     if folder_name is not None:
         imgName = os.path.join(folder_name, imgName)
+    if reserved is None:
+        reserved = set()
     # check we don't overwrite existing file
     i = 1
     name = imgName[:-(len(extension)+1)]
-    while os.path.exists(imgName):
+    while os.path.exists(imgName) or imgName in reserved:
         imgName = "%s_(%d).%s" % (name, i, extension)
         i += 1
+    reserved.add(imgName)
     return imgName
 
 
-def saveAsOmeTiff(conn, image, folder_name=None):
+class PlaneRenderPool(object):
     """
-    Saves the image as an ome.tif in the specified folder
+    Renders and saves planes on a pool of worker threads.
+
+    Each worker loads its own copies of the image, so that changing the
+    active channels for one plane doesn't affect planes rendered by other
+    workers. The number of renders in flight on the connection is never more
+    than the number of workers. File names are chosen up front, in the same
+    order as the serial export, so the exported files are the same.
     """
 
+    def __init__(self, conn, workers):
+        self.conn = conn
+        self.pool = ThreadPool(workers)
+        self.local = threading.local()
+        # don't let the task queue run too far ahead of the workers
+        self.slots = threading.BoundedSemaphore(workers * 2)
+        self.reserved = set()
+        self.results = []
+        self.lock = threading.Lock()
+        self.images = []
+
+    def getImage(self, imageId, merged):
+        """
+        Returns this worker's ImageWrapper for the image. 'merged' planes use
+        a wrapper that keeps the saved rendering settings, split channels
+        use another.
+        """
+        cached = getattr(self.local, "images", None)
+        if cached is None or cached[0] != imageId:
+            if cached is not None:
+                for img in cached[1].values():
+                    self.closeImage(img)
+            cached = (imageId, {})
+            self.local.images = cached
+        if merged not in cached[1]:
+            img = self.conn.getObject("Image", imageId)
+            cached[1][merged] = img
+            with self.lock:
+                self.images.append(img)
+        return cached[1][merged]
+
+    def closeImage(self, image):
+        with self.lock:
+            if image in self.images:
+                self.images.remove(image)
+        if image._re is not None:
+            image._re.close()
+            image._re = None
+
+    def submit(self, image, format, cName, zRange, projectZ, t, channel,
+               greyscale, zoomPercent, folder_name, **kwargs):
+        """
+        Queues a plane for saving, blocking while the workers are busy.
+        Keyword arguments are passed on to savePlane().
+        """
+        extension = getExtension(format)[0]
+        archive = kwargs.get('archive')
+        reserved = self.reserved if archive is None else archive.reserved
+        kwargs['imgName'] = makeImageName(image.getName(), cName, zRange, t,
+                                          extension, folder_name, reserved)
+        args = (format, cName, zRange, projectZ, t, channel, greyscale,
+                zoomPercent, folder_name)
+        self.queue(self.run, image.getId(), channel is None, args, kwargs)
+
+    def run(self, imageId, merged, args, kwargs):
+        savePlane(self.getImage(imageId, merged), *args, **kwargs)
+
+    def queue(self, func, *args, **kwargs):
+        """
+        Runs func(*args, **kwargs) on a worker, blocking while the workers
+        are busy.
+        """
+        self.slots.acquire()
+        self.results.append(self.pool.apply_async(
+            self.call, (func, args, kwargs)))
+
+    def call(self, func, args, kwargs):
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.slots.release()
+
+    def close(self):
+        """
+        Waits for all queued planes to be saved and shuts down the workers.
+        Re-raises the first error from any worker.
+        """
+        self.pool.close()
+        try:
+            for r in self.results:
+                r.get()
+        finally:
+            self.pool.join()
+            for img in list(self.images):
+                self.closeImage(img)
+
+
+class ExportPipeline(object):
+    """
+    Resizes, encodes and writes rendered planes, with workers threads for
+    each stage and short queues between them. Rendering the next planes
+    overlaps with saving the previous ones, and a slow stage holds up the
+    stages before it instead of letting planes pile up in memory.
+
+    The memory used by planes from the start of rendering until they are
+    written is kept under memoryLimit bytes: reserve() blocks until there is
+    room.
+    """
+
+    def __init__(self, memoryLimit, queueSize=2, workers=1):
+        """
+        @param memoryLimit:     Bytes that planes waiting to be saved can use
+        @param queueSize:       Planes waiting for each stage, per worker
+        @param workers:         Threads for each stage. Match the number of
+                                planes rendered at once, so that encoding
+                                keeps up with rendering.
+        """
+        self.memoryLimit = memoryLimit
+        self.inUse = 0
+        self.memory = threading.Condition()
+        self.error = None
+        # names handed out for planes that are not written yet
+        self.reserved = set()
+        self.workers = workers
+        self.queues = [Queue.Queue(queueSize * workers) for i in range(3)]
+        stages = [self.resize, self.encode, self.write]
+        # threads of each stage still running
+        self.running = [workers] * len(stages)
+        self.lock = threading.Lock()
+        self.threads = []
+        for i, stage in enumerate(stages):
+            for w in range(workers):
+                thread = threading.Thread(target=self.runStage,
+                                          args=(stage, i))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def reserve(self, nbytes):
+        """
+        Blocks until nbytes can be used without going over the memory
+        limit. A plane bigger than the limit waits until nothing else is
+        held.
+        """
+        with self.memory:
+            while self.inUse > 0 and self.inUse + nbytes > self.memoryLimit:
+                self.memory.wait()
+            self.inUse += nbytes
+
+    def release(self, nbytes):
+        with self.memory:
+            self.inUse -= nbytes
+            self.memory.notify_all()
+
+    def save(self, plane, size, name, pilFormat, archive, nbytes,
+             onSaved=None, record=None):
+        """
+        Queues the PIL image to be resized to size (unless None), encoded
+        and written to the file or archive, blocking while the queue is
+        full. The nbytes reserved for it are released once it is written,
+        and onSaved() is called. If a record from planeRecord() is given,
+        the stage timings are added and it is logged with logPlane().
+        """
+        if self.error is not None:
+            self.release(nbytes)
+            raise self.error
+        if record is None:
+            record = {}
+        self.queues[0].put(
+            [plane, size, name, pilFormat, archive, nbytes, onSaved, record])
+
+    def runStage(self, stage, i):
+        inQueue = self.queues[i]
+        outQueue = None
+        if i + 1 < len(self.queues):
+            outQueue = self.queues[i + 1]
+        while True:
+            item = inQueue.get()
+            if item is None:
+                with self.lock:
+                    self.running[i] -= 1
+                    last = self.running[i] == 0
+                # the last thread of the stage stops the next stage
+                if last and outQueue is not None:
+                    for w in range(self.workers):
+                        outQueue.put(None)
+                return
+            failed = self.error is not None
+            if not failed:
+                try:
+                    stage(item)
+                except Exception, e:
+                    self.error = e
+                    failed = True
+            if failed:
+                # drop the plane, but keep draining the queue
+                self.release(item[5])
+            elif outQueue is not None:
+                outQueue.put(item)
+
+    def resize(self, item):
+        plane, size = item[:2]
+        start = time.time()
+        if size is not None and plane.size != size:
+            item[0] = plane.resize(size, Image.ANTIALIAS)
+        item[7]['resize_ms'] = msSince(start)
+
+    def encode(self, item):
+        start = time.time()
+        buf = StringIO()
+        item[0].save(buf, item[3])
+        # the encoded data replaces the plane
+        item[0] = buf.getvalue()
+        item[7]['encode_ms'] = msSince(start)
+
+    def write(self, item):
+        data, size, name, pilFormat, archive, nbytes, onSaved, record = item
+        start = time.time()
+        writeFile(name, data, archive)
+        if onSaved is not None:
+            onSaved()
+        if record:
+            record['write_ms'] = msSince(start)
+            record['bytes'] = len(data)
+            logPlane(record)
+        # don't hold the data while waiting for the next plane
+        item[0] = None
+        self.release(nbytes)
+
+    def close(self):
+        """
+        Waits for the queued planes to be written and stops the threads.
+        Re-raises the first error from any stage.
+        """
+        for w in range(self.workers):
+            self.queues[0].put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def getOmeTiffName(image, folder_name=None, reserved=None):
+    """
+    Produces the name for the saved ome.tif. E.g. myImage.dv.ome.tif
+
+    @param reserved:    Optional set of names already handed out for files
+                        that may not be on disk yet. The new name is added.
+    """
     extension = "ome.tif"
     name = os.path.basename(image.getName())
     imgName = "%s.%s" % (name, extension)
     if folder_name is not None:
         imgName = os.path.join(folder_name, imgName)
+    if reserved is None:
+        reserved = set()
     # check we don't overwrite existing file
     i = 1
     pathName = imgName[:-(len(extension)+1)]
-    while os.path.exists(imgName):
+    while os.path.exists(imgName) or imgName in reserved:
         imgName = "%s_(%d).%s" % (pathName, i, extension)
         i += 1
+    reserved.add(imgName)
+    return imgName
+
+
+def getOmeTiffBufsize(image):
+    """
+    Picks the block size to read the OME-TIFF with: 1/64 of the pixel data,
+    between 64 KB and 4 MB. Big files are read in fewer calls to the
+    server, while small files don't need a big buffer.
+    """
+    bitSize = image.getPrimaryPixels().getPixelsType().getBitSize() or 16
+    pixelData = (image.getSizeX() * image.getSizeY() * image.getSizeZ() *
+                 image.getSizeC() * image.getSizeT() * bitSize // 8)
+    return int(min(max(pixelData // 64, 64 * 1024), 4 * 1024 * 1024))
+
+
+def saveAsOmeTiff(conn, image, folder_name=None, archive=None, imgName=None):
+    """
+    Saves the image as an ome.tif in the specified folder, or streams it into
+    the archive if given. The archive deflates it into a temporary file, so
+    other downloads are not kept waiting for the archive.
+
+    @param imgName:     Name to save the file as. If None, use
+                        getOmeTiffName()
+    """
+    if imgName is None:
+        reserved = None if archive is None else archive.reserved
+        imgName = getOmeTiffName(image, folder_name, reserved)
 
     log("  Saving file as: %s" % imgName)
-    fileSize, block_gen = image.exportOmeTiff(bufsize=65536)
+    bufsize = getOmeTiffBufsize(image)
+    fileSize, block_gen = image.exportOmeTiff(bufsize=bufsize)
+    if archive is not None:
+        archive.writeBlocks(imgName, block_gen)
+        return
     f = open(str(imgName), "wb")
     for piece in block_gen:
         f.write(piece)
@@ -198,10 +1598,125 @@ def saveAsOmeTiff(conn, image, folder_name=None):
     f.close()
 
 
+def getPhysicalSizes(image):
+    """
+    Returns the physical pixel sizes of the image as a dict of 'x', 'y' and
+    'z' (None if not set), with 'unit' E.g. 'micrometer' if the server
+    gives the units and they are the same for every axis. Otherwise 'units'
+    gives the unit of each axis that has one.
+    """
+    sizes = {}
+    units = {}
+    for axis in ('x', 'y', 'z'):
+        getter = getattr(image, "getPixelSize%s" % axis.upper())
+        try:
+            size = getter(units=True)
+        except TypeError:
+            # servers before units don't say
+            sizes[axis] = getter()
+            continue
+        if size is None:
+            sizes[axis] = None
+            continue
+        sizes[axis] = size.getValue()
+        units[axis] = str(size.getUnit()).lower()
+    if len(set(units.values())) == 1:
+        sizes['unit'] = units.values()[0]
+    elif units:
+        sizes['units'] = units
+    return sizes
+
+
+def saveAsChunkedArray(image, zRange, tRange, chunkSize, folder_name=None,
+                       archive=None):
+    """
+    Saves the raw pixels of the image as a directory of chunks, in the
+    specified folder or the archive if given. Each chunk is a .npy file of
+    up to chunkSize x chunkSize pixels from one plane, named t.c.z.y.x.npy
+    by its position in the chunk grid. metadata.json gives the dimensions,
+    pixel type, physical sizes and chunk shape.
+
+    @param zRange:      Tuple: (zIndex,) OR (zStart, zStop) 1-based.
+                        If None, use the default Z.
+    @param tRange:      Tuple: (tIndex,) OR (tStart, tStop) 1-based.
+                        If None, use the default T.
+    @param chunkSize:   Maximum width and height of each chunk
+    """
+    if zRange is None:
+        zRange = (image.getDefaultZ()+1,)
+    if tRange is None:
+        tRange = (image.getDefaultT()+1,)
+    zIndexes = [zRange[0]]
+    if len(zRange) > 1:
+        zIndexes = range(zRange[0], zRange[1])
+    tIndexes = [tRange[0]]
+    if len(tRange) > 1:
+        tIndexes = range(tRange[0], tRange[1])
+
+    extension = "npy"
+    name = os.path.basename(image.getName())
+    dirName = "%s_%s" % (name, extension)
+    if folder_name is not None:
+        dirName = os.path.join(folder_name, dirName)
+    reserved = set() if archive is None else archive.reserved
+    # check we don't overwrite existing folder
+    i = 1
+    pathName = dirName
+    while os.path.exists(dirName) or dirName in reserved:
+        dirName = "%s_(%d)" % (pathName, i)
+        i += 1
+    reserved.add(dirName)
+    if archive is None:
+        os.mkdir(dirName)
+    log("  Saving chunks to: %s" % dirName)
+
+    pixels = image.getPrimaryPixels()
+    sizeX = image.getSizeX()
+    sizeY = image.getSizeY()
+    sizeC = image.getSizeC()
+    tiles = []
+    for y in range(0, sizeY, chunkSize):
+        for x in range(0, sizeX, chunkSize):
+            tiles.append((x, y, min(chunkSize, sizeX - x),
+                          min(chunkSize, sizeY - y)))
+    zctTileList = [(z-1, c, t-1, tile) for t in tIndexes
+                   for c in range(sizeC) for z in zIndexes for tile in tiles]
+    dtype = None
+    chunks = pixels.getTiles(zctTileList)
+    for z, c, t, tile in zctTileList:
+        chunk = chunks.next()
+        dtype = chunk.dtype
+        chunkName = "%d.%d.%d.%d.%d.%s" % (
+            tIndexes.index(t+1), c, zIndexes.index(z+1),
+            tile[1] // chunkSize, tile[0] // chunkSize, extension)
+        buf = StringIO()
+        numpy.save(buf, chunk)
+        writeFile(os.path.join(dirName, chunkName), buf.getvalue(), archive)
+
+    metadata = {
+        'image': image.getId(),
+        'name': image.getName(),
+        'dimensions': ['t', 'c', 'z', 'y', 'x'],
+        'shape': [len(tIndexes), sizeC, len(zIndexes), sizeY, sizeX],
+        'chunks': [1, 1, 1, chunkSize, chunkSize],
+        # index of the first exported plane in the image, 0-based
+        'origin': {'t': tIndexes[0]-1, 'z': zIndexes[0]-1},
+        'pixelType': pixels.getPixelsType().value,
+        'dtype': dtype.str,
+        'physicalSizes': getPhysicalSizes(image),
+        'channels': [ch.getLabel() for ch in image.getChannels()],
+        'chunkNames': "t.c.z.y.x.%s" % extension,
+    }
+    writeFile(os.path.join(dirName, "metadata.json"),
+              json.dumps(metadata, indent=1, sort_keys=True), archive)
+
+
 def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
                        channelNames=None, zRange=None, tRange=None,
                        greyscale=False, zoomPercent=None, projectZ=False,
-                       format="PNG", folder_name=None):
+                       format="PNG", folder_name=None, pool=None,
+                       archive=None, tileSize=None, manifest=None,
+                       rendering=None, pipeline=None):
     """
     Saves all the required planes for a single image, either as individual
     planes or projection.
@@ -216,9 +1731,31 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
     @param greyscale:           If true, all visible channels will be
                                 greyscale
     @param zoomPercent:         Resize image by this percent if specified.
-    @param projectZ:            If true, project over Z range.
+    @param projectZ:            'intmax', 'intmean' or 'intsum' to project
+                                over Z range. False for no projection.
+    @param pool:                Optional PlaneRenderPool. If given, planes
+                                are queued on the pool instead of being
+                                saved one at a time.
+    @param archive:             Optional ZipExport to write the planes into,
+                                instead of the folder.
+    @param tileSize:            If specified, save each plane as tiles of
+                                this size. Used for 'Big' images.
+    @param manifest:            Optional ExportManifest to record the saved
+                                files in, and copy unchanged planes from.
+    @param rendering:           Settings from getLinearRendering(). If given,
+                                all the images for each Z and T are rendered
+                                locally from one fetch of the raw planes.
+    @param pipeline:            Optional ExportPipeline to resize, encode and
+                                write the rendered planes.
     """
 
+    save = savePlane if pool is None else pool.submit
+    options = {'archive': archive, 'tileSize': tileSize,
+               'pipeline': pipeline}
+    if manifest is not None:
+        options['manifest'] = manifest
+        options['settings'] = getRenderingSettings(image)
+
     channels = []
     if mergedCs:
         # render merged first with current rendering settings
@@ -246,6 +1783,8 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
         else:
             tIndexes = [tRange[0]]
 
+    # list the planes to save, in the order they are named
+    planes = []
     cName = 'merged'
     for c in channels:
         if c is not None:
@@ -260,19 +1799,52 @@ def savePlanesForImage(conn, image, sizeC, splitCs, mergedCs,
         for t in tIndexes:
             if zRange is None:
                 defaultZ = image.getDefaultZ()+1
-                savePlane(image, format, cName, (defaultZ,), projectZ, t, c,
-                          gScale, zoomPercent, folder_name)
+                planes.append((cName, (defaultZ,), t, c, gScale))
             elif projectZ:
-                savePlane(image, format, cName, zRange, projectZ, t, c,
-                          gScale, zoomPercent, folder_name)
+                planes.append((cName, zRange, t, c, gScale))
             else:
                 if len(zRange) > 1:
                     for z in range(zRange[0], zRange[1]):
-                        savePlane(image, format, cName, (z,), projectZ, t, c,
-                                  gScale, zoomPercent, folder_name)
+                        planes.append((cName, (z,), t, c, gScale))
                 else:
-                    savePlane(image, format, cName, zRange, projectZ, t, c,
-                              gScale, zoomPercent, folder_name)
+                    planes.append((cName, zRange, t, c, gScale))
+
+    if rendering is None:
+        for cName, planeZ, t, c, gScale in planes:
+            save(image, format, cName, planeZ, projectZ, t, c, gScale,
+                 zoomPercent, folder_name, **options)
+        return
+
+    # render locally: group the planes by Z and T, so the raw pixels for
+    # each Z and T are only fetched once for all channels
+    if archive is not None:
+        reserved = archive.reserved
+    elif pool is not None:
+        reserved = pool.reserved
+    elif pipeline is not None:
+        reserved = pipeline.reserved
+    else:
+        reserved = set()
+    extension = getExtension(format)[0]
+    pixels = image.getPrimaryPixels()
+    groups = {}
+    order = []
+    for cName, planeZ, t, c, gScale in planes:
+        imgName = makeImageName(image.getName(), cName, planeZ, t, extension,
+                                folder_name, reserved)
+        if (planeZ, t) not in groups:
+            groups[(planeZ, t)] = []
+            order.append((planeZ, t))
+        groups[(planeZ, t)].append((imgName, c, gScale))
+    options = {'archive': archive, 'manifest': manifest,
+               'settings': options.get('settings'), 'pipeline': pipeline}
+    for planeZ, t in order:
+        args = (image, pixels, rendering, planeZ, t, groups[(planeZ, t)],
+                format, projectZ, zoomPercent)
+        if pool is None:
+            saveLocalPlanes(*args, **options)
+        else:
+            pool.queue(saveLocalPlanes, *args, **options)
 
 
 def batchImageExport(conn, scriptParams):
@@ -285,8 +1857,9 @@ def batchImageExport(conn, scriptParams):
     folder_name = scriptParams["Folder_Name"]
     folder_name = os.path.basename(folder_name)
     format = scriptParams["Format"]
-    projectZ = "Choose_Z_Section" in scriptParams and \
-        scriptParams["Choose_Z_Section"] == 'Max projection'
+    projectZ = False
+    if "Choose_Z_Section" in scriptParams:
+        projectZ = PROJECTIONS.get(scriptParams["Choose_Z_Section"], False)
 
     if (not splitCs) and (not mergedCs):
         log("Not chosen to save Individual Channels OR Merged Image")
@@ -299,6 +1872,33 @@ def batchImageExport(conn, scriptParams):
     zoomPercent = None
     if "Zoom" in scriptParams and scriptParams["Zoom"] != "100%":
         zoomPercent = int(scriptParams["Zoom"][:-1])
+    workers = 1
+    if "Parallel_Renders" in scriptParams:
+        workers = max(1, scriptParams["Parallel_Renders"])
+    streamToZip = "Stream_To_Zip" in scriptParams and \
+        scriptParams["Stream_To_Zip"]
+    bigTileSize = 2048
+    if "Big_Image_Tile_Size" in scriptParams:
+        bigTileSize = scriptParams["Big_Image_Tile_Size"]
+    reusePrevious = "Reuse_Previous_Export" in scriptParams and \
+        scriptParams["Reuse_Previous_Export"]
+    renderLocally = "Render_Locally" in scriptParams and \
+        scriptParams["Render_Locally"]
+    memoryLimit = 512
+    if "Memory_Limit_MB" in scriptParams:
+        memoryLimit = scriptParams["Memory_Limit_MB"]
+    omeTiffWorkers = 1
+    if "Parallel_OME_TIFF_Exports" in scriptParams:
+        omeTiffWorkers = max(1, scriptParams["Parallel_OME_TIFF_Exports"])
+    maxZipSize = None
+    if "Max_Zip_Size_MB" in scriptParams and \
+            scriptParams["Max_Zip_Size_MB"] > 0:
+        maxZipSize = scriptParams["Max_Zip_Size_MB"] * 1024 * 1024
+    zipPerDataset = dataType == 'Dataset' and \
+        "Zip_Per_Dataset" in scriptParams and scriptParams["Zip_Per_Dataset"]
+    if maxZipSize is not None or zipPerDataset:
+        # volumes are uploaded as they are written
+        streamToZip = True
 
     # functions used below for each imaage.
     def getZrange(sizeZ, scriptParams):
@@ -308,6 +1908,15 @@ def batchImageExport(conn, scriptParams):
             # NB: all Z indices in this script are 1-based
             if zChoice == 'ALL Z planes':
                 zRange = (1, sizeZ+1)
+            elif zChoice in PROJECTIONS:
+                # project the Z start-end range, or the whole stack
+                zRange = (1, sizeZ+1)
+                if "OR_specify_Z_start_AND..." in scriptParams and \
+                        "...specify_Z_end" in scriptParams:
+                    start = min(scriptParams["OR_specify_Z_start_AND..."],
+                                sizeZ)
+                    end = min(scriptParams["...specify_Z_end"], sizeZ)
+                    zRange = (min(start, end), max(start, end)+1)
             elif "OR_specify_Z_index" in scriptParams:
                 zIndex = scriptParams["OR_specify_Z_index"]
                 zIndex = min(zIndex, sizeZ)
@@ -363,42 +1972,150 @@ def batchImageExport(conn, scriptParams):
     # Attach figure to the first image
     parent = objects[0]
 
+    # list of (image, dataset)
     if dataType == 'Dataset':
         images = []
         for ds in objects:
-            images.extend(list(ds.listChildren()))
+            images.extend([(img, ds) for img in ds.listChildren()])
         if not images:
             message += "No image found in dataset(s)"
             return None, message
     else:
-        images = objects
+        images = [(img, None) for img in objects]
 
     log("Processing %s images" % len(images))
 
     # somewhere to put images
     curr_dir = os.getcwd()
     exp_dir = os.path.join(curr_dir, folder_name)
-    try:
-        os.mkdir(exp_dir)
-    except:
-        pass
+    zipBaseName = folder_name
+    archive = None
+    # dataset ID (or None): ZipVolumes. Created when first needed
+    archives = {}
+    # the ZipVolumes in the order they were created
+    volumeSets = []
+    zipNames = set([zipBaseName])
+    uploader = None
+    if streamToZip:
+        # write each file straight into the zip - nothing in exp_dir
+        folder_name = None
+        uploader = ThreadPool(1)
+    else:
+        try:
+            os.mkdir(exp_dir)
+        except:
+            pass
+
+    def getArchive(dataset):
+        # the zip file(s) to write this dataset's images to
+        if not zipPerDataset:
+            dataset = None
+        key = None if dataset is None else dataset.getId()
+        if key not in archives:
+            name = zipBaseName
+            zipParent = parent
+            if dataset is not None:
+                dsName = getDatasetZipName(dataset)
+                name = "%s_%s" % (zipBaseName, dsName)
+                i = 1
+                while name in zipNames:
+                    name = "%s_%s(%d)" % (zipBaseName, dsName, i)
+                    i += 1
+                zipNames.add(name)
+                zipParent = dataset
+            archives[key] = ZipVolumes(conn, name, zipParent, maxZipSize,
+                                       uploader)
+            volumeSets.append(archives[key])
+        return archives[key]
+
+    def writeLog(archive=None):
+        # write log for exported images (not needed for ome-tiff), and the
+        # timings of each exported file
+        logs = [('Batch_Image_Export.txt', logFile)]
+        if len(planeLog) > 0:
+            logs.append(('Batch_Image_Export_planes.jsonl', planeLog))
+        for name, logged in logs:
+            if archive is not None:
+                archive.writeBlocks(name, logged.blocks())
+                continue
+            f = open(os.path.join(exp_dir, name), 'w')
+            try:
+                for block in logged.blocks():
+                    f.write(block)
+            finally:
+                f.close()
+
+    # record what we export, and reuse unchanged planes from the last export
+    manifest = None
+    previousZips = []
+    rendered = format not in ('OME-TIFF', 'Chunked NPY')
+    if rendered:
+        manifest = ExportManifest()
+        if reusePrevious:
+            datasetNames = []
+            if zipPerDataset:
+                datasetNames = [getDatasetZipName(ds) for ds in objects]
+            previousZips = findPreviousExport(conn, objects, zipBaseName,
+                                              EXPORT_NS, datasetNames)
+        if previousZips:
+            log("Previous export lists %s files"
+                % manifest.loadPrevious(previousZips))
 
     # do the saving to disk
-
-    for img in images:
-        if img._prepareRE().requiresPixelsPyramid():
+    pool = None
+    if workers > 1 and rendered:
+        log("Rendering up to %s planes in parallel" % workers)
+        pool = PlaneRenderPool(conn, workers)
+    pipeline = None
+    if rendered:
+        pipeline = ExportPipeline(memoryLimit * 1024 * 1024,
+                                  workers=workers)
+    omeTiffPool = None
+    omeTiffExports = []
+    # names of the ome.tif files being exported
+    omeTiffNames = set()
+    if omeTiffWorkers > 1 and format == 'OME-TIFF':
+        log("Exporting up to %s OME-TIFF files in parallel" % omeTiffWorkers)
+        omeTiffPool = ThreadPool(omeTiffWorkers)
+
+    for img, dataset in images:
+        renderingEngine = img._prepareRE()
+        bigImage = renderingEngine.requiresPixelsPyramid()
+        renderingEngine.close()
+        if bigImage and format == 'OME-TIFF':
             log("  ** Can't export a 'Big' image to %s. **" % format)
             if len(images) == 1:
+                if pool is not None:
+                    pool.close()
+                if pipeline is not None:
+                    pipeline.close()
+                if omeTiffPool is not None:
+                    omeTiffPool.close()
+                if uploader is not None:
+                    uploader.close()
                 return None, "Can't export a 'Big' image to %s." % format
             continue
         else:
             log("Exporting image as %s: %s" % (format, img.getName()))
-
-        if format == 'OME-TIFF':
-            saveAsOmeTiff(conn, img, folder_name)
+        if streamToZip:
+            archive = getArchive(dataset)
+
+        if format == 'OME-TIFF' and omeTiffPool is not None:
+            # name the file now, so names don't depend on which export
+            # finishes first
+            reserved = omeTiffNames if archive is None else archive.reserved
+            imgName = getOmeTiffName(img, folder_name, reserved)
+            omeTiffExports.append(omeTiffPool.apply_async(
+                saveAsOmeTiff, (conn, img, folder_name, archive),
+                {'imgName': imgName}))
+        elif format == 'OME-TIFF':
+            saveAsOmeTiff(conn, img, folder_name, archive)
+        elif format == 'Chunked NPY':
+            saveAsChunkedArray(
+                img, getZrange(img.getSizeZ(), scriptParams),
+                getTrange(img.getSizeT(), scriptParams), bigTileSize,
+                folder_name, archive)
         else:
-            if img._prepareRE().requiresPixelsPyramid():
-                log("  ** Can't export a 'Big' image to OME-TIFF. **")
             log("\n----------- Saving planes from image: '%s' ------------"
                 % img.getName())
             sizeC = img.getSizeC()
@@ -413,8 +2130,24 @@ def batchImageExport(conn, scriptParams):
                 log("  Z-index: %d" % zRange[0])
             else:
                 log("  Z-range: %s-%s" % (zRange[0], zRange[1]-1))
-            if projectZ:
-                log("  Z-projection: ON")
+            imgProjectZ = projectZ
+            tileSize = None
+            if bigImage:
+                tileSize = bigTileSize
+                log("  'Big' image: saving tiles of %s x %s pixels"
+                    % (tileSize, tileSize))
+                if projectZ:
+                    log("  ** Can't project a 'Big' image. **")
+                    imgProjectZ = False
+            if imgProjectZ:
+                log("  Z-projection: %s" % imgProjectZ)
+            rendering = None
+            if renderLocally and not bigImage:
+                rendering = getLinearRendering(img)
+                if rendering is None:
+                    log("  Rendering on server: not all channels are linear")
+                else:
+                    log("  Rendering locally from raw planes")
             if tRange is None:
                 log("  T-index: Last-viewed")
             elif len(tRange) == 1:
@@ -434,22 +2167,57 @@ def batchImageExport(conn, scriptParams):
 
             savePlanesForImage(
                 conn, img, sizeC, splitCs, mergedCs, channelNames, zRange,
-                tRange, greyscale, zoomPercent, projectZ=projectZ,
-                format=format, folder_name=folder_name)
-
-        # write log for exported images (not needed for ome-tiff)
-        logFile = open(os.path.join(exp_dir, 'Batch_Image_Export.txt'), 'w')
-        try:
-            for s in logStrings:
-                logFile.write(s)
-                logFile.write("\n")
-        finally:
-            logFile.close()
-
-    if len(os.listdir(exp_dir)) == 0:
+                tRange, greyscale, zoomPercent, projectZ=imgProjectZ,
+                format=format, folder_name=folder_name, pool=pool,
+                archive=archive, tileSize=tileSize, manifest=manifest,
+                rendering=rendering, pipeline=pipeline)
+
+    if pool is not None:
+        # wait for the queued planes
+        pool.close()
+    if pipeline is not None:
+        pipeline.close()
+    if omeTiffPool is not None:
+        omeTiffPool.close()
+        omeTiffPool.join()
+        # re-raise any errors
+        for export in omeTiffExports:
+            export.get()
+    if not streamToZip:
+        writeLog()
+
+    if manifest is not None:
+        manifest.close()
+        for zipName, path in previousZips:
+            os.remove(path)
+        if manifest.entries:
+            manifestName = ExportManifest.FILENAME
+            if streamToZip:
+                archive = volumeSets[0]
+            else:
+                manifestName = os.path.join(exp_dir, manifestName)
+            writeFile(manifestName, manifest.toJson(), archive)
+
+    if streamToZip:
+        if sum([len(v) for v in volumeSets]) > 0:
+            # the log goes with the manifest (if any)
+            writeLog(volumeSets[0])
+        uploads = []
+        for archive in volumeSets:
+            uploads.extend(archive.close())
+        uploader.close()
+        uploader.join()
+        if not uploads:
+            return None, "No files exported. See 'info' for more details"
+        fileAnnotation, annMessage = uploads[0]
+        message += annMessage
+        if len(uploads) > 1:
+            message += " (%s zip files)" % len(uploads)
+        return fileAnnotation, message
+    elif len(os.listdir(exp_dir)) == 0:
         return None, "No files exported. See 'info' for more details"
     # zip everything up (unless we've only got a single ome-tiff)
-    if format == 'OME-TIFF' and len(os.listdir(exp_dir)) == 1:
+    elif format == 'OME-TIFF' and len(os.listdir(exp_dir)) == 1:
         ometiffIds = [t.id for t in parent.listAnnotations(ns=NSOMETIFF)]
         print "Deleting OLD ome-tiffs: %s" % ometiffIds
         conn.deleteObjects("Annotation", ometiffIds)
@@ -462,7 +2230,7 @@ def batchImageExport(conn, scriptParams):
         compress(export_file, folder_name)
         mimetype = 'application/zip'
         outputDisplayName = "Batch export zip"
-        namespace = NSCREATED + "/omero/export_scripts/Batch_Image_Export"
+        namespace = EXPORT_NS
 
     fileAnnotation, annMessage = script_utils.createLinkFileAnnotation(
         conn, export_file, parent, output=outputDisplayName, ns=namespace,
@@ -479,12 +2247,13 @@ def runScript():
 
     dataTypes = [rstring('Dataset'), rstring('Image')]
     formats = [rstring('JPEG'), rstring('PNG'), rstring('TIFF'),
-               rstring('OME-TIFF')]
+               rstring('OME-TIFF'), rstring('Chunked NPY')]
     defaultZoption = 'Default-Z (last-viewed)'
     zChoices = [rstring(defaultZoption),
                 rstring('ALL Z planes'),
-                # currently ImageWrapper only allows full Z-stack projection
                 rstring('Max projection'),
+                rstring('Mean projection'),
+                rstring('Sum projection'),
                 rstring('Other (see below)')]
     defaultToption = 'Default-T (last-viewed)'
     tChoices = [rstring(defaultToption),
@@ -539,11 +2308,13 @@ users/client-tutorials/insight/insight-util-scripts.html""",
 
         scripts.Int(
             "OR_specify_Z_start_AND...", grouping="5.2",
-            description="Choose a specific Z-index to export", min=1),
+            description="Choose a specific Z-index to export, or the start"
+            " of the projection range", min=1),
 
         scripts.Int(
             "...specify_Z_end", grouping="5.3",
-            description="Choose a specific Z-index to export", min=1),
+            description="Choose a specific Z-index to export, or the end"
+            " of the projection range", min=1),
 
         scripts.String(
             "Choose_T_Section", grouping="6",
@@ -565,11 +2336,13 @@ users/client-tutorials/insight/insight-util-scripts.html""",
         scripts.String(
             "Zoom", grouping="7", values=zoomPercents,
             description="Zoom (jpeg, png or tiff) before saving with"
-            " ANTIALIAS interpolation", default="100%"),
+            " ANTIALIAS interpolation. Below 100%, the server renders from a"
+            " smaller resolution level, or every nth pixel", default="100%"),
 
         scripts.String(
             "Format", grouping="8",
-            description="Format to save image", values=formats,
+            description="Format to save image. Chunked NPY saves the raw"
+            " pixels as .npy chunks for analysis", values=formats,
             default='JPEG'),
 
         scripts.String(
@@ -577,6 +2350,57 @@ users/client-tutorials/insight/insight-util-scripts.html""",
             description="Name of folder (and zip file) to store images",
             default='Batch_Image_Export'),
 
+        scripts.Int(
+            "Big_Image_Tile_Size", grouping="8.1",
+            description="'Big' images are saved (jpeg, png or tiff) as a"
+            " grid of tiles of this size. Also the size of Chunked NPY"
+            " chunks", default=2048, min=256),
+
+        scripts.Bool(
+            "Stream_To_Zip", grouping="9.1",
+            description="Write images straight into the zip file, instead"
+            " of saving them to the folder and zipping it afterwards",
+            default=False),
+
+        scripts.Bool(
+            "Reuse_Previous_Export", grouping="9.2",
+            description="Copy planes whose rendering settings haven't"
+            " changed from the last export with the same Folder_Name,"
+            " instead of rendering them again", default=False),
+
+        scripts.Int(
+            "Max_Zip_Size_MB", grouping="9.3",
+            description="Split the export into zip files of up to this"
+            " size, each uploaded as soon as it is full. 0 for no limit."
+            " Writes images straight into the zip files", default=0, min=0),
+
+        scripts.Bool(
+            "Zip_Per_Dataset", grouping="9.4",
+            description="Export the images of each Dataset to their own"
+            " zip file(s), attached to the Dataset", default=False),
+
+        scripts.Int(
+            "Parallel_Renders", grouping="10",
+            description="Number of planes to render and save at the same"
+            " time. 1 saves one plane at a time.", default=1, min=1, max=8),
+
+        scripts.Bool(
+            "Render_Locally", grouping="10.1",
+            description="Fetch the raw pixels once for each Z and T and"
+            " render the merged and individual channel images here, instead"
+            " of asking the server to render each image. Only for channels"
+            " with linear rendering settings", default=False),
+
+        scripts.Int(
+            "Parallel_OME_TIFF_Exports", grouping="10.2",
+            description="Number of images to export as OME-TIFF at the same"
+            " time", default=1, min=1, max=8),
+
+        scripts.Int(
+            "Memory_Limit_MB", grouping="10.3",
+            description="Limit on the memory used by rendered images waiting"
+            " to be resized, encoded and saved", default=512, min=16),
+
         version="4.3.0",
         authors=["William Moore", "OME Team"],
         institutions=["University of Dundee"],
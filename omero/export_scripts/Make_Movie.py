@@ -65,15 +65,22 @@ import omero.min  # Constants etc.
 import os
 import sys
 import re
+import subprocess
+import tempfile
+import threading
+import zipfile
 import numpy
 import omero.util.pixelstypetopython as pixelstypetopython
-from struct import unpack
-from omero.rtypes import wrap, rstring, rint, rlong, robject
+from omero.rtypes import wrap, rstring, rint, rlong, robject, unwrap
 from omero.gateway import BlitzGateway
 from omero.constants.namespaces import NSCREATED
 from omero.constants.metadata import NSMOVIE
+from omero.constants.projection import ProjectionType
 
+import hashlib
 from cStringIO import StringIO
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from types import StringTypes
 
 try:
@@ -97,9 +104,19 @@ formatMimetypes = {
     QT: "video/quicktime",
     WMV: "video/x-ms-wmv"}
 OVERLAYCOLOUR = "#666666"
+# Z_Projection options
+NO_PROJECTION = 'None'
+PROJECTIONS = {'Max projection': ProjectionType.MAXIMUMINTENSITY,
+               'Mean projection': ProjectionType.MEANINTENSITY,
+               'Sum projection': ProjectionType.SUMINTENSITY}
+# rendered planes kept between runs, see Frame_Cache_MB
+FRAME_CACHE_DIR = os.path.join(tempfile.gettempdir(), "Make_Movie_frames")
 
 
 logLines = []    # make a log / legend of the figure
+# plane acquisition times by (pixels ID, channel)
+acquisitionTimes = {}
+acquisitionTimesLock = threading.Lock()
 
 
 def log(text):
@@ -112,21 +129,26 @@ def log(text):
 
 
 def downloadPlane(gateway, pixels, pixelsId, x, y, z, c, t):
-    """ Retrieves the selected plane """
+    """
+    Retrieves the selected plane as a (y, x) array of the pixels type.
+    The big-endian bytes from the server are read in place and converted
+    to native byte order in one copy.
+    """
     rawPlane = gateway.getPlane(pixelsId, z, c, t)
-    convertType = '>' + str(x*y) + pixelstypetopython.toPython(
-        pixels.getPixelsType().getValue())
-    convertedPlane = unpack(convertType, rawPlane)
-    remappedPlane = numpy.array(
-        convertedPlane, dtype=(pixels.getPixelsType().getValue()))
-    remappedPlane.resize(x, y)
-    return remappedPlane
+    convertType = numpy.dtype('>' + pixelstypetopython.toPython(
+        pixels.getPixelsType().getValue()))
+    remappedPlane = numpy.frombuffer(rawPlane, dtype=convertType)
+    remappedPlane = remappedPlane.astype(convertType.newbyteorder('='))
+    return remappedPlane.reshape(y, x)
 
 
 def uploadPlane(gateway, newPixelsId, x, y, z, c, t, newPlane):
-    """Uploads the specified plane. """
-    byteSwappedPlane = newPlane.byteswap()
-    convertedPlane = byteSwappedPlane.tostring()
+    """
+    Uploads the specified plane. Only byte-swaps into a new array when the
+    plane isn't already big-endian.
+    """
+    bigEndian = newPlane.dtype.newbyteorder('>')
+    convertedPlane = newPlane.astype(bigEndian, copy=False).tostring()
     gateway.uploadPlane(newPixelsId, z, c, t, convertedPlane)
 
 
@@ -138,25 +160,71 @@ def macOSX():
         return 0
 
 
-def buildAVI(sizeX, sizeY, filelist, fps, movieName, format):
-    """ Encodes. """
-    program = 'mencoder'
-    args = ""
+def startEncoder(sizeX, sizeY, fps, movieName, format, inputFps=None):
+    """
+    Starts mencoder reading raw RGB frames from its stdin, so frames are
+    streamed straight to the encoder instead of being saved to disk first.
+
+    @param sizeX:       Width of every frame
+    @param sizeY:       Height of every frame
+    @param fps:         Frames per second of the movie
+    @param movieName:   Name of the movie file to write
+    @param format:      One of MPEG, QT or WMV
+    @param inputFps:    Frames per second written to the encoder, if not
+                        fps. mencoder repeats frames to make up fps
+                        without encoding them again.
+    @return:            The encoder process. Use writeFrame() and
+                        finishEncoder()
+    """
     if (format == WMV):
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=wmv2 -o %s' % movieName
+        codec = 'vcodec=wmv2'
     elif (format == QT):
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps='+str(fps) + \
-            ':type=png -ovc lavc -lavcopts vcodec=mjpeg:vbitrate=800  -o %s' \
-            % movieName
+        codec = 'vcodec=mjpeg:vbitrate=800'
     else:
-        args = ' mf://'+filelist + ' -mf w=' + str(sizeX) + ':h=' + \
-            str(sizeY) + ':fps=' + str(fps) + \
-            ':type=jpg -ovc lavc -lavcopts vcodec=mpeg4 -o %s' % movieName
-    log(args)
-    os.system(program + args)
+        codec = 'vcodec=mpeg4'
+    args = ['mencoder', '-', '-demuxer', 'rawvideo', '-rawvideo',
+            'fps=%s:w=%s:h=%s:format=rgb24' % (inputFps or fps, sizeX, sizeY),
+            '-ovc', 'lavc', '-lavcopts', codec, '-o', movieName]
+    if inputFps is not None:
+        args[-2:-2] = ['-ofps', str(fps)]
+    log(" ".join(args))
+    return subprocess.Popen(args, stdin=subprocess.PIPE)
+
+
+def joinMovies(fileNames, movieName):
+    """
+    Joins movies made with the same size, frame rate and format into one,
+    without encoding them again.
+
+    @return:            mencoder's exit status
+    """
+    args = ['mencoder'] + fileNames + ['-ovc', 'copy', '-o', movieName]
+    log(" ".join(args))
+    return subprocess.call(args)
+
+
+def frameData(image):
+    """ Returns the PIL image as packed RGB bytes for the encoder. """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if hasattr(image, "tobytes"):
+        return image.tobytes()
+    return image.tostring()
+
+
+def writeFrame(encoder, data, count=1):
+    """ Writes the frame data to the encoder count times. """
+    for i in range(count):
+        encoder.stdin.write(data)
+
+
+def finishEncoder(encoder):
+    """ Closes the encoder's input and waits for the movie to be written. """
+    try:
+        encoder.stdin.close()
+    except IOError:
+        pass
+    return encoder.wait()
 
 
 def rangeFromList(list, index):
@@ -169,41 +237,63 @@ def rangeFromList(list, index):
 
 
 def calculateAquisitionTime(conn, pixelsId, cList, tzList):
-    """ Loads the plane information. """
-    queryService = conn.getQueryService()
+    """
+    Loads the acquisition time (deltaT) of every plane of the first channel
+    in cList with one query, returning only the Z, T and time. The times of
+    each pixels set and channel are only loaded once.
 
-    tRange = ",".join([str(i) for i in rangeFromList(tzList, 0)])
-    zRange = ",".join([str(i) for i in rangeFromList(tzList, 1)])
-    cRange = ",".join([str(i) for i in cList])
-    query = "from PlaneInfo as Info where Info.theZ in (%s) and Info.theT" \
-        " in (%s) and Info.theC in (%s) and pixels.id='%s'" \
-        % (zRange, tRange, cRange, pixelsId)
-    infoList = queryService.findAllByQuery(query, None)
-
-    map = {}
-    for info in infoList:
-        if (info.deltaT is None):
-            return None
-        key = "z:" + str(info.theZ.getValue()) + "t:" + \
-            str(info.theT.getValue())
-        if key in map:
-            value = map.get(key)
-            value = value+info.deltaT.getValue()
-            map[key] = value
-        else:
-            map[key] = info.deltaT.getValue()
-    for key in map:
-        map[key] = map[key]/len(cRange)
-    return map
+    @return:        Array of the times indexed [t, z], with NaN where there
+                    is no time. None if there are no times.
+    """
+    theC = 0
+    if len(cList) > 0:
+        theC = cList[0]
+    key = (pixelsId, theC)
+    with acquisitionTimesLock:
+        if key in acquisitionTimes:
+            return acquisitionTimes[key]
+
+    queryService = conn.getQueryService()
+    params = omero.sys.ParametersI()
+    params.addLong("pid", pixelsId)
+    params.addLong("c", theC)
+    query = "select info.theZ, info.theT, info.deltaT from PlaneInfo as" \
+        " info where info.pixels.id = :pid and info.theC = :c"
+    rows = unwrap(queryService.projection(query, params, conn.SERVICE_OPTS))
+
+    timeMap = None
+    if rows:
+        rows = numpy.array(
+            [(z, t, numpy.nan if deltaT is None else deltaT)
+             for z, t, deltaT in rows], dtype=float)
+        zIndex = rows[:, 0].astype(int)
+        tIndex = rows[:, 1].astype(int)
+        timeMap = numpy.empty((tIndex.max() + 1, zIndex.max() + 1))
+        timeMap.fill(numpy.nan)
+        timeMap[tIndex, zIndex] = rows[:, 2]
+    with acquisitionTimesLock:
+        acquisitionTimes[key] = timeMap
+    return timeMap
+
+
+def hasAquisitionTimes(timeMap, tzList):
+    """ Checks there is a time in timeMap for every [t, z] in tzList """
+    if timeMap is None:
+        return False
+    tIndex = numpy.array([tz[0] for tz in tzList])
+    zIndex = numpy.array([tz[1] for tz in tzList])
+    if tIndex.max() >= timeMap.shape[0] or zIndex.max() >= timeMap.shape[1]:
+        return False
+    return not numpy.isnan(timeMap[tIndex, zIndex]).any()
 
 
-def addScalebar(scalebar, image, pixels, commandArgs):
-    """ Adds the scalebar. """
+def addScalebar(scalebar, image, pixels, commandArgs, scale=1.0):
+    """ Adds the scalebar. scale is the size of the frames / the image. """
     image_w, image_h = image.size
     draw = ImageDraw.Draw(image)
     if (pixels.getPhysicalSizeX() is None):
         return image
-    pixelSizeX = pixels.getPhysicalSizeX()
+    pixelSizeX = pixels.getPhysicalSizeX() / scale
     if (pixelSizeX <= 0):
         return image
     scaleBarY = image_h-30
@@ -220,8 +310,11 @@ def addScalebar(scalebar, image, pixels, commandArgs):
     return image
 
 
-def addPlaneInfo(z, t, pixels, image, colour):
-    """ Displays the plane information. """
+def addPlaneInfo(z, t, pixels, image, colour, zEnd=None):
+    """
+    Displays the plane information. zEnd is the end of the Z range of a
+    projection.
+    """
     image_w, image_h = image.size
     draw = ImageDraw.Draw(image)
     planeInfoTextY = image_h-60
@@ -229,6 +322,8 @@ def addPlaneInfo(z, t, pixels, image, colour):
     if(planeInfoTextY <= 0 or textX > image_w or planeInfoTextY > image_h):
         return image
     planeCoord = "z:"+str(z+1)+" t:"+str(t+1)
+    if zEnd is not None and zEnd != z:
+        planeCoord = "z:"+str(z+1)+"-"+str(zEnd+1)+" t:"+str(t+1)
     draw.text((textX, planeInfoTextY), planeCoord, fill=colour)
     return image
 
@@ -265,17 +360,360 @@ def getRenderingEngine(conn, pixelsId, sizeC, cRange):
     return renderingEngine
 
 
-def getPlane(renderingEngine, z, t):
-    """ Retrieves the specified XY-plane. """
+def getPlane(renderingEngine, z, t, region=None):
+    """
+    Retrieves the specified XY-plane, or only the (x, y, width, height)
+    region of it.
+    """
     planeDef = omero.romio.PlaneDef()
     planeDef.t = t
     planeDef.z = z
     planeDef.x = 0
     planeDef.y = 0
     planeDef.slice = 0
+    if region is not None:
+        regionDef = omero.romio.RegionDef()
+        regionDef.x, regionDef.y, regionDef.width, regionDef.height = region
+        planeDef.region = regionDef
     return renderingEngine.renderAsPackedInt(planeDef)
 
 
+def getResolutionLevel(image, region, scale):
+    """
+    Picks the smallest resolution level of a 'Big' image that is still at
+    least as big as the scaled image, so we render as few pixels as possible.
+
+    @param image:           ImageWrapper with rendering engine prepared
+    @param region:          The (x, y, width, height) at full size, or None
+    @param scale:           The fraction of the full size we want
+    @return:                Tuple of (level, region, (sizeX, sizeY)) where
+                            region is scaled to the level and sizeX, sizeY
+                            are the size rendered. level is None if the
+                            image has no resolution levels.
+    """
+    pixels = image.getPrimaryPixels()
+    fullX = pixels.getSizeX()
+    fullY = pixels.getSizeY()
+    if not image._re.requiresPixelsPyramid():
+        if region is None:
+            return None, None, (fullX, fullY)
+        return None, region, tuple(region[2:])
+    descriptions = image._re.getResolutionDescriptions()
+    # descriptions are ordered from full size down, but resolution levels
+    # are numbered from the smallest up.
+    best = 0
+    for i, d in enumerate(descriptions):
+        if d.sizeX >= descriptions[0].sizeX * scale:
+            best = i
+    level = image._re.getResolutionLevels() - 1 - best
+    levelX = descriptions[best].sizeX
+    levelY = descriptions[best].sizeY
+    if region is None:
+        return level, None, (levelX, levelY)
+    fx = float(levelX) / fullX
+    fy = float(levelY) / fullY
+    x = min(int(region[0] * fx), levelX - 1)
+    y = min(int(region[1] * fy), levelY - 1)
+    width = min(max(int(round(region[2] * fx)), 1), levelX - x)
+    height = min(max(int(round(region[3] * fy)), 1), levelY - y)
+    return level, (x, y, width, height), (width, height)
+
+
+def getProjectedPlane(renderingEngine, t, projection):
+    """
+    Retrieves the whole XY-plane at t projected over a Z range on the
+    server, so no projected image has to be made first.
+
+    @param projection:      Tuple of (ProjectionType, zStart, zEnd)
+    """
+    algorithm, zStart, zEnd = projection
+    return renderingEngine.renderProjectedAsPackedInt(
+        algorithm, t, 1, zStart, zEnd)
+
+
+def getRegion(commandArgs, sizeX, sizeY):
+    """
+    Returns the (x, y, width, height) region chosen with the X, Y, Width
+    and Height parameters, clipped to the image. None for the whole plane.
+    """
+    x = min(max(commandArgs.get("X", 0), 0), sizeX - 1)
+    y = min(max(commandArgs.get("Y", 0), 0), sizeY - 1)
+    width = min(max(commandArgs.get("Width", sizeX), 1), sizeX - x)
+    height = min(max(commandArgs.get("Height", sizeY), 1), sizeY - y)
+    if (x, y, width, height) == (0, 0, sizeX, sizeY):
+        return None
+    return x, y, width, height
+
+
+def planeToImage(plane, sizeX, sizeY):
+    """ Converts a plane from renderAsPackedInt() to an RGBA PIL image. """
+    planeImage = numpy.array(plane, dtype='uint32')
+    planeImage = planeImage.byteswap()
+    planeImage = planeImage.reshape(sizeX, sizeY)
+    return Image.frombuffer('RGBA', (sizeX, sizeY), planeImage.data,
+                            'raw', 'ARGB', 0, 1)
+
+
+def getRenderingDefImageId(conn, rdefId):
+    """
+    Returns the ID of the image whose pixels the rendering def belongs to,
+    or None if there is no such rendering def.
+    """
+    params = omero.sys.ParametersI()
+    params.addId(rdefId)
+    query = "select rdef.pixels.image.id from RenderingDef as rdef" \
+        " where rdef.id = :id"
+    rows = unwrap(conn.getQueryService().projection(query, params,
+                                                    conn.SERVICE_OPTS))
+    if not rows:
+        return None
+    return rows[0][0]
+
+
+def prepareImage(image, commandArgs, cRange, cWindows, cColours):
+    """
+    Sets up the rendering engine of the image with the chosen rendering
+    def, active channels, windows and colours.
+    """
+    if commandArgs["RenderingDef_ID"] >= 0:
+        image._prepareRenderingEngine(rdid=commandArgs["RenderingDef_ID"])
+    image.setActiveChannels(map(lambda x: x+1, cRange), cWindows, cColours)
+    return image
+
+
+def getRenderingSettings(renderingEngine, cRange):
+    """
+    Returns the rendering settings of the active channels that change how
+    frames look, as a tuple to use in a FrameCache key.
+    """
+    settings = [renderingEngine.getRenderingDefId(),
+                unwrap(renderingEngine.getModel().getValue())]
+    for c in cRange:
+        settings.append((
+            c, renderingEngine.getChannelWindowStart(c),
+            renderingEngine.getChannelWindowEnd(c),
+            tuple(renderingEngine.getRGBA(c)),
+            unwrap(renderingEngine.getChannelFamily(c).getValue()),
+            renderingEngine.getChannelCurveCoefficient(c)))
+    return tuple(settings)
+
+
+class FrameCache(object):
+    """
+    Rendered planes kept on local disk between runs of the script, so that
+    movies that only change the encoding or the overlays don't render the
+    planes again. The least recently used planes are deleted to keep the
+    cache under its size limit.
+    """
+
+    def __init__(self, path, maxBytes):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path, 0700)
+            except OSError:
+                if not os.path.isdir(path):
+                    raise
+        self.size = sum(size for name, size, used in self.listFiles())
+
+    def listFiles(self):
+        """ Returns (name, size, last used) for each cached plane. """
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".rgb"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((name, st.st_size, st.st_mtime))
+        return files
+
+    def fileName(self, key):
+        return os.path.join(
+            self.path, hashlib.sha1(repr(key)).hexdigest() + ".rgb")
+
+    def get(self, key):
+        """ Returns the cached data for the key, or None. """
+        fileName = self.fileName(key)
+        try:
+            f = open(fileName, "rb")
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            # mark as recently used
+            os.utime(fileName, None)
+        except (IOError, OSError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """ Adds the data to the cache, deleting old planes if needed. """
+        fileName = self.fileName(key)
+        fd, tempName = tempfile.mkstemp(".tmp", dir=self.path)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tempName, fileName)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.maxBytes:
+                self.prune()
+
+    def prune(self):
+        """
+        Deletes the least recently used planes, down to 90% of the size
+        limit. Call with the lock.
+        """
+        files = sorted(self.listFiles(), key=lambda f: f[2])
+        self.size = sum(f[1] for f in files)
+        for name, size, used in files:
+            if self.size <= self.maxBytes * 0.9:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                self.size -= size
+            except OSError:
+                pass
+
+
+class FrameRenderer(object):
+    """
+    Renders the frames of a movie and draws the overlays on them.
+
+    With more than one worker, frames are rendered on a pool of threads.
+    Each worker loads its own copy of the image, with its own rendering
+    engine, so the server renders several planes at once. Frames are
+    returned in the order they were asked for, and no more than two per
+    worker are held in memory waiting for their turn.
+    """
+
+    def __init__(self, conn, image, channels, decorate, workers=1,
+                 region=None, level=None, renderSize=None, size=None,
+                 cache=None, cacheKey=None, projection=None):
+        """
+        @param image:       The ImageWrapper, already prepared
+        @param channels:    The (commandArgs, cRange, cWindows, cColours)
+                            used to prepare each worker's copy of the image
+        @param decorate:    Function(image, z, t) drawing the overlays on
+                            a frame. Returns the PIL image.
+        @param workers:     Number of frames to render at the same time
+        @param region:      The (x, y, width, height) to render, or None
+                            for the whole plane
+        @param level:       Resolution level to render, or None
+        @param renderSize:  The (sizeX, sizeY) of the rendered planes.
+                            Default is the size of the image.
+        @param size:        The (sizeX, sizeY) of the frames, if the planes
+                            need scaling
+        @param cache:       FrameCache for the rendered planes, or None
+        @param cacheKey:    Tuple identifying the image and its rendering
+                            settings in the cache
+        @param projection:  (ProjectionType, zStart, zEnd) to render a Z
+                            projection for each T, or None. The whole
+                            plane is projected and cropped to the region.
+        """
+        self.conn = conn
+        self.image = image
+        self.channels = channels
+        self.decorate = decorate
+        self.workers = workers
+        self.region = region
+        self.level = level
+        if renderSize is None:
+            pixels = image.getPrimaryPixels()
+            renderSize = (pixels.getSizeX(), pixels.getSizeY())
+        self.renderSize = renderSize
+        self.size = size or renderSize
+        self.cache = cache
+        self.cacheKey = cacheKey
+        self.projection = projection
+        if level is not None:
+            image._re.setResolutionLevel(level)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.copies = []
+
+    def getImage(self):
+        """ Returns this thread's ImageWrapper. """
+        if self.workers < 2:
+            return self.image
+        image = getattr(self.local, "image", None)
+        if image is None:
+            image = self.conn.getObject("Image", self.image.getId())
+            prepareImage(image, *self.channels)
+            if self.level is not None:
+                image._re.setResolutionLevel(self.level)
+            self.local.image = image
+            with self.lock:
+                self.copies.append(image)
+        return image
+
+    def render(self, z, t):
+        """ Renders the frame for z, t. Returns the RGB frame data. """
+        image = None
+        if self.cache is not None:
+            key = self.cacheKey + (z, t)
+            data = self.cache.get(key)
+            if data is not None:
+                image = Image.frombuffer('RGB', self.size, data, 'raw',
+                                         'RGB', 0, 1)
+        if image is None:
+            if self.projection is None:
+                plane = getPlane(self.getImage()._re, z, t, self.region)
+                image = planeToImage(plane, *self.renderSize)
+            else:
+                image = self.renderProjection(t)
+            if self.size != self.renderSize:
+                image = image.resize(self.size, Image.ANTIALIAS)
+            if self.cache is not None:
+                image = image.convert("RGB")
+                self.cache.put(key, frameData(image))
+        return frameData(self.decorate(image, z, t))
+
+    def renderProjection(self, t):
+        """ Renders the projection at t, cropped to the region. """
+        pixels = self.image.getPrimaryPixels()
+        plane = getProjectedPlane(self.getImage()._re, t, self.projection)
+        image = planeToImage(plane, pixels.getSizeX(), pixels.getSizeY())
+        if self.region is not None:
+            x, y, width, height = self.region
+            image = image.crop((x, y, x + width, y + height))
+        return image
+
+    def frames(self, tzList):
+        """ Yields the RGB frame data for each [t, z] in order. """
+        if self.workers < 2:
+            for t, z in tzList:
+                yield self.render(z, t)
+            return
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        try:
+            for t, z in tzList:
+                pending.append(pool.apply_async(self.render, (z, t)))
+                if len(pending) >= self.workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.close()
+            pool.join()
+            self.close()
+
+    def close(self):
+        """ Closes the rendering engines of the workers' images. """
+        with self.lock:
+            copies, self.copies = self.copies, []
+        for image in copies:
+            if image._re is not None:
+                image._re.close()
+                image._re = None
+
+
 def inRange(low, high, max):
     """ Determines if the passed values are in the range. """
     if(low < 0 or low > high):
@@ -389,58 +827,123 @@ def reshape_to_fit(image, sizeX, sizeY, bg=(0, 0, 0)):
     return bg
 
 
-def write_intro_end_slides(conn, commandArgs, orig_file_id, duration, sizeX,
-                           sizeY):
+def loadImageFile(conn, orig_file_id):
+    """
+    Reads an Original File (png or jpeg) as a PIL Image.
     """
-    Uses an original file (jpeg or png) to add frames to the movie.
-    Scales and pads to fit sizeX, sizeY.
+    image_file = conn.getObject("OriginalFile", orig_file_id)
+    image_data = "".join(image_file.getFileInChunks())
+    i = StringIO(image_data)
+    image = Image.open(i)
+    image.load()
+    return image
+
 
+class MovieAssets(object):
+    """
+    The intro and ending slides and the watermark, shared by all the movies
+    made by the script. Each Original File is downloaded once, and scaled
+    once for each movie size.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.images = {}
+        self.scaled = {}
+        self.movies = {}
+
+    def getImage(self, orig_file_id):
+        """ Returns the Original File as a PIL Image. Call with the lock. """
+        if orig_file_id not in self.images:
+            self.images[orig_file_id] = loadImageFile(self.conn, orig_file_id)
+        return self.images[orig_file_id]
+
+    def getSlide(self, orig_file_id, sizeX, sizeY):
+        """ Returns the RGB frame data of the slide, fitted to sizeX, sizeY """
+        key = ("slide", orig_file_id, sizeX, sizeY)
+        with self.lock:
+            if key not in self.scaled:
+                slide = reshape_to_fit(self.getImage(orig_file_id), sizeX,
+                                       sizeY)
+                self.scaled[key] = frameData(slide)
+            return self.scaled[key]
+
+    def getSlideMovie(self, orig_file_id, duration, sizeX, sizeY, fps,
+                      format):
+        """
+        Returns the name of a movie showing the slide for duration seconds,
+        or None if it couldn't be made. Each one is only encoded once.
+        """
+        key = ("movie", orig_file_id, duration, sizeX, sizeY, fps, format)
+        with self.lock:
+            if key in self.movies:
+                return self.movies[key]
+        data = self.getSlide(orig_file_id, sizeX, sizeY)
+        with self.lock:
+            if key not in self.movies:
+                self.movies[key] = write_intro_end_slides(
+                    data, orig_file_id, duration, sizeX, sizeY, fps, format)
+            return self.movies[key]
+
+    def close(self):
+        """ Deletes the slide movies. """
+        for fileName in self.movies.values():
+            if fileName is not None and os.path.exists(fileName):
+                os.remove(fileName)
+
+    def getWatermark(self, orig_file_id, sizeX, sizeY):
+        """ Returns the watermark as a PIL Image, to fit sizeX, sizeY """
+        key = ("watermark", orig_file_id, sizeX, sizeY)
+        with self.lock:
+            if key not in self.scaled:
+                self.scaled[key] = prepareWatermark(
+                    self.getImage(orig_file_id), sizeX, sizeY)
+            return self.scaled[key]
+
+
+def write_intro_end_slides(slide_data, orig_file_id, duration, sizeX, sizeY,
+                           fps, format):
+    """
+    Makes a movie of the slide from an original file (jpeg or png), to be
+    joined to the start or end of the movie. The slide is encoded once
+    for each second and mencoder repeats it to make up the frame rate.
+
+    @param slide_data:      RGB frame data of the slide, fitted to the movie
     @param orig_file_id:    Original File (png or jpeg) ID
     @param duration:        Duration of intro / end (secs)
     @param sizeX:           Width of the exported movie
     @param sizeY:           Height of the exported movie
-    @return:                List of file names to add to mencoder list
+    @param fps:             Frames per second of the exported movie
+    @param format:          Format of the exported movie
+    @return:                Name of the movie file or None
     """
 
-    slide_filenames = []
-    fps = commandArgs["FPS"]
-    format = commandArgs["Format"]
-
-    # get Original File as Image
-    slide_file = conn.getObject("OriginalFile", orig_file_id)
-    slide_data = "".join(slide_file.getFileInChunks())
-    i = StringIO(slide_data)
-    slide = Image.open(i)
-    slide = reshape_to_fit(slide, sizeX, sizeY)
-
-    # write the file once
-    if format == QT:
-        filename = 'slide_%s.png' % orig_file_id
-        slide.save(filename, "PNG")
-    else:
-        filename = 'slide_%s.jpg' % orig_file_id
-        slide.save(filename, "JPEG")
-    # control duration by adding the filename multiple times
-    for i in range(duration * fps):
-        slide_filenames.append(filename)
-
-    return slide_filenames
+    filename = 'slide_%s_%sx%s_%ss.%s' % (orig_file_id, sizeX, sizeY,
+                                          duration, formatMap[format])
+    try:
+        encoder = startEncoder(sizeX, sizeY, fps, filename, format, 1)
+    except OSError, e:
+        print "mencoder could not be started: %s" % e
+        return None
+    try:
+        writeFrame(encoder, slide_data, duration)
+    except IOError, e:
+        print "Writing slide to mencoder failed: %s" % e
+    if finishEncoder(encoder) != 0 or not os.path.exists(filename):
+        print "mencoder Failed to create slide movie: %s" % filename
+        return None
+    return filename
 
 
-def prepareWatermark(conn, commandArgs, sizeX, sizeY):
+def prepareWatermark(wm, sizeX, sizeY):
     """
-    Read Original File (png or jpeg) to use as watermark,
-    scale if needed to fit movie (sizeX, sizeY) and return
+    Scale the watermark image if needed to fit movie (sizeX, sizeY) and
+    return
 
     @return:        PIL Image to use as watermark.
     """
 
-    wm_orig_file = commandArgs["Watermark"]
-    # get Original File as Image
-    wm_file = conn.getObject("OriginalFile", wm_orig_file.id.val)
-    wm_data = "".join(wm_file.getFileInChunks())
-    i = StringIO(wm_data)
-    wm = Image.open(i)
     wm_w, wm_h = wm.size
     # only resize watermark if too big
     if wm_w > sizeX or wm_h > sizeY:
@@ -461,31 +964,58 @@ def pasteWatermark(image, watermark):
     return image
 
 
-def writeMovie(commandArgs, conn):
+def prepareOverlay(commandArgs, pixels, watermark, sizeX, sizeY, scale=1.0):
     """
-    Makes the movie.
+    Composites the overlays that are the same on every frame, the scalebar
+    and the watermark, once into an RGBA layer the size of the movie. The
+    layer is cropped to the part that isn't transparent.
 
-    @ returns        Returns the file annotation
+    @param scale:   Size of the frames / size of the image, for the scalebar
+    @return:        (RGB image, alpha mask, position) of the layer, or None
+                    if there is nothing to draw
     """
-    log("Movie created by OMERO")
-    log("")
+    layer = Image.new("RGBA", (sizeX, sizeY), (0, 0, 0, 0))
+    if "Scalebar" in commandArgs and commandArgs["Scalebar"]:
+        layer = addScalebar(commandArgs["Scalebar"], layer, pixels,
+                            commandArgs, scale)
+    if watermark is not None:
+        wmLayer = Image.new("RGBA", (sizeX, sizeY), (0, 0, 0, 0))
+        wmLayer.paste(watermark.convert("RGBA"),
+                      (0, sizeY - watermark.size[1]))
+        if hasattr(Image, "alpha_composite"):
+            layer = Image.alpha_composite(layer, wmLayer)
+        else:
+            # PIL before Pillow 2.0: blend using the watermark's alpha
+            layer.paste(wmLayer, (0, 0), wmLayer)
+    bbox = layer.getbbox()
+    if bbox is None:
+        return None
+    layer = layer.crop(bbox)
+    return layer.convert("RGB"), layer.split()[3], bbox[:2]
 
-    message = ""
 
-    session = conn.c.sf
-    updateService = session.getUpdateService()
-    rawFileStore = session.createRawFileStore()
+def applyOverlay(image, overlay):
+    """
+    Blends the layer from prepareOverlay() onto the frame. Return image
+    """
+    if overlay is not None:
+        rgb, alpha, position = overlay
+        image.paste(rgb, position, alpha)
+    return image
 
-    # Get the images
-    images, logMessage = scriptUtil.getObjects(conn, commandArgs)
-    message += logMessage
-    if not images:
-        return None, message
-    # Get the first valid image (should be expanded to process the list)
-    omeroImage = images[0]
 
-    if commandArgs["RenderingDef_ID"] >= 0:
-        omeroImage._prepareRenderingEngine(rdid=commandArgs["RenderingDef_ID"])
+def makeMovie(conn, omeroImage, commandArgs, assets, output, cache=None):
+    """
+    Makes the movie of one image.
+
+    @param omeroImage:      The ImageWrapper
+    @param commandArgs:     The script parameters. Not modified
+    @param assets:          The MovieAssets with the slides and watermark
+    @param output:          Local file name to write the movie to
+    @param cache:           FrameCache for the rendered planes, or None
+    @return:                The movie file name or None, and a message
+    """
+    commandArgs = dict(commandArgs)
     pixels = omeroImage.getPrimaryPixels()
     pixelsId = pixels.getId()
 
@@ -497,7 +1027,16 @@ def writeMovie(commandArgs, conn):
 
     if (sizeX is None or sizeY is None or sizeZ is None or sizeT is None or
             sizeC is None):
-        return
+        return None, "Image %s has no pixels. " % omeroImage.getId()
+
+    # only render the chosen region, the movie is the size of the region
+    region = getRegion(commandArgs, sizeX, sizeY)
+    if region is not None:
+        sizeX, sizeY = region[2:]
+    scale = 1.0
+    if "Max_Size" in commandArgs and \
+            max(sizeX, sizeY) > commandArgs["Max_Size"]:
+        scale = float(commandArgs["Max_Size"]) / max(sizeX, sizeY)
 
     if (pixels.getPhysicalSizeX() is None):
         commandArgs["Scalebar"] = 0
@@ -523,18 +1062,40 @@ def writeMovie(commandArgs, conn):
 
     tzList = calculateRanges(sizeZ, sizeT, commandArgs)
 
-    timeMap = calculateAquisitionTime(conn, pixelsId, cRange, tzList)
-    if (timeMap is None):
-        commandArgs["Show_Time"] = False
-    if (timeMap is not None):
-        if (len(timeMap) == 0):
+    # one frame for each T, projecting the whole Z range
+    projection = None
+    if "Z_Projection" in commandArgs and \
+            commandArgs["Z_Projection"] in PROJECTIONS:
+        zIndexes = [tz[1] for tz in tzList]
+        zStart = min(zIndexes)
+        projection = (PROJECTIONS[commandArgs["Z_Projection"]], zStart,
+                      max(zIndexes))
+        tIndexes = set()
+        projected = []
+        for t, z in tzList:
+            if t not in tIndexes:
+                tIndexes.add(t)
+                projected.append([t, zStart])
+        tzList = projected
+
+    timeMap = None
+    if "Show_Time" in commandArgs and commandArgs["Show_Time"]:
+        timeMap = calculateAquisitionTime(conn, pixelsId, cRange, tzList)
+        if not hasAquisitionTimes(timeMap, tzList):
             commandArgs["Show_Time"] = False
 
-    frameNo = 1
-    omeroImage.setActiveChannels(map(lambda x: x+1, cRange),
-                                 cWindows,
-                                 cColours)
-    renderingEngine = omeroImage._re
+    channels = (commandArgs, cRange, cWindows, cColours)
+    prepareImage(omeroImage, *channels)
+
+    if projection is not None and omeroImage._re.requiresPixelsPyramid():
+        return None, "Can't project big image %s. " % omeroImage.getId()
+
+    # render big images from the smallest resolution level we can
+    level, renderRegion, renderSize = getResolutionLevel(
+        omeroImage, region, scale)
+    if scale < 1:
+        sizeX = max(1, int(sizeX * scale))
+        sizeY = max(1, int(sizeY * scale))
 
     overlayColour = (255, 255, 255)
     if "Overlay_Colour" in commandArgs:
@@ -552,71 +1113,148 @@ def writeMovie(commandArgs, conn):
     canvas = None
     if sizeX < mw or sizeY < mh:
         ovlpos = ((mw-sizeX) / 2, (mh-sizeY) / 2)
-        canvas = Image.new("RGBA", (mw, mh), canvasColour)
+        canvas = Image.new("RGB", (mw, mh), canvasColour)
+
+    workers = 1
+    if "Parallel_Renders" in commandArgs:
+        workers = max(1, commandArgs["Parallel_Renders"])
 
     format = commandArgs["Format"]
-    fileNames = []
-
-    # add intro...
-    if "Intro_Slide" in commandArgs and commandArgs["Intro_Slide"].id:
-        intro_duration = commandArgs["Intro_Duration"]
-        intro_fileId = commandArgs["Intro_Slide"].id.val
-        intro_filenames = write_intro_end_slides(
-            conn, commandArgs, intro_fileId, intro_duration, mw, mh)
-        fileNames.extend(intro_filenames)
-
-    # prepare watermark
-    if "Watermark" in commandArgs and commandArgs["Watermark"].id:
-        watermark = prepareWatermark(conn, commandArgs, mw, mh)
-
-    # add movie frames...
-    for tz in tzList:
-        t = tz[0]
-        z = tz[1]
-        plane = getPlane(renderingEngine, z, t)
-        planeImage = numpy.array(plane, dtype='uint32')
-        planeImage = planeImage.byteswap()
-        planeImage = planeImage.reshape(sizeX, sizeY)
-        image = Image.frombuffer('RGBA', (sizeX, sizeY), planeImage.data,
-                                 'raw', 'ARGB', 0, 1)
-        if ovlpos is not None:
-            image2 = canvas.copy()
-            image2.paste(image, ovlpos, image)
-            image = image2
-
-        if "Scalebar" in commandArgs and commandArgs["Scalebar"]:
-            image = addScalebar(
-                commandArgs["Scalebar"], image, pixels, commandArgs)
-        planeInfo = "z:"+str(z)+"t:"+str(t)
-        if "Show_Time" in commandArgs and commandArgs["Show_Time"]:
-            time = timeMap[planeInfo]
-            image = addTimePoints(time, pixels, image, overlayColour)
-        if "Show_Plane_Info" in commandArgs and \
-                commandArgs["Show_Plane_Info"]:
-            image = addPlaneInfo(z, t, pixels, image, overlayColour)
+    framesPerSec = 2
+    if "FPS" in commandArgs:
+        framesPerSec = commandArgs["FPS"]
+
+    # intro and ending are made once and joined to the movie frames
+    slides = [None, None]
+    if "Intro_Slide" in commandArgs and commandArgs["Intro_Slide"].id and \
+            commandArgs["Intro_Duration"] > 0:
+        slides[0] = assets.getSlideMovie(
+            commandArgs["Intro_Slide"].id.val, commandArgs["Intro_Duration"],
+            mw, mh, framesPerSec, format)
+    if "Ending_Slide" in commandArgs and commandArgs["Ending_Slide"].id and \
+            commandArgs["Ending_Duration"] > 0:
+        slides[1] = assets.getSlideMovie(
+            commandArgs["Ending_Slide"].id.val,
+            commandArgs["Ending_Duration"], mw, mh, framesPerSec, format)
+    frames = output
+    if slides != [None, None]:
+        frames = "frames_%s" % output
+
+    try:
+        encoder = startEncoder(mw, mh, framesPerSec, frames, format)
+    except OSError, e:
+        print "mencoder could not be started: %s" % e
+        return None, "Failed to create movie file: %s. " % output
+
+    try:
+        # prepare watermark
+        watermark = None
         if "Watermark" in commandArgs and commandArgs["Watermark"].id:
-            image = pasteWatermark(image, watermark)
-        if format == QT:
-            filename = str(frameNo) + '.png'
-            image.save(filename, "PNG")
-        else:
-            filename = str(frameNo) + '.jpg'
-            image.save(filename, "JPEG")
-        fileNames.append(filename)
-        frameNo += 1
-
-    # add exit frames... "outro"
-    # add intro...
-    if "Ending_Slide" in commandArgs and commandArgs["Ending_Slide"].id:
-        end_duration = commandArgs["Ending_Duration"]
-        end_fileId = commandArgs["Ending_Slide"].id.val
-        end_filenames = write_intro_end_slides(
-            conn, commandArgs, end_fileId, end_duration, mw, mh)
-        fileNames.extend(end_filenames)
-
-    filelist = ",".join(fileNames)
+            watermark = assets.getWatermark(
+                commandArgs["Watermark"].id.val, mw, mh)
+        overlay = prepareOverlay(commandArgs, pixels, watermark, mw, mh,
+                                 scale)
+
+        def decorate(image, z, t):
+            """ Pads the frame to the canvas and draws the overlays. """
+            image = image.convert("RGB")
+            if ovlpos is not None:
+                image2 = canvas.copy()
+                image2.paste(image, ovlpos)
+                image = image2
+
+            # only the text changes from frame to frame
+            if "Show_Time" in commandArgs and commandArgs["Show_Time"]:
+                time = timeMap[t, z]
+                image = addTimePoints(time, pixels, image, overlayColour)
+            if "Show_Plane_Info" in commandArgs and \
+                    commandArgs["Show_Plane_Info"]:
+                image = addPlaneInfo(z, t, pixels, image, overlayColour,
+                                     projection and projection[2])
+            return applyOverlay(image, overlay)
+
+        # add movie frames...
+        cacheKey = None
+        if cache is not None:
+            cacheKey = (pixelsId, tuple(cRange),
+                        getRenderingSettings(omeroImage._re, cRange),
+                        renderRegion, level, renderSize, (sizeX, sizeY),
+                        projection)
+        renderer = FrameRenderer(conn, omeroImage, channels, decorate,
+                                 workers, renderRegion, level, renderSize,
+                                 (sizeX, sizeY), cache, cacheKey, projection)
+        for frame in renderer.frames(tzList):
+            writeFrame(encoder, frame)
+    except IOError, e:
+        # mencoder exited early, its own output says why
+        print "Writing frames to mencoder failed: %s" % e
+    finally:
+        status = finishEncoder(encoder)
+
+    if status == 0 and frames != output and os.path.exists(frames):
+        parts = [slides[0], frames, slides[1]]
+        status = joinMovies([p for p in parts if p is not None], output)
+        os.remove(frames)
+
+    if status != 0 or not os.path.exists(output):
+        print "mencoder Failed to create movie file: %s" % output
+        return None, "Failed to create movie file: %s. " % output
+    return output, ""
+
+
+def uploadMovie(conn, path, name, parent, mimetype, doLink):
+    """
+    Uploads the file, attached to the parent if doLink is True.
+
+    @return:        The FileAnnotation or OriginalFile, and a message
+    """
+    if not doLink:
+        session = conn.c.sf
+        updateService = session.getUpdateService()
+        rawFileStore = session.createRawFileStore()
+        try:
+            originalFile = scriptUtil.createFile(
+                updateService, path, mimetype, name)
+            scriptUtil.uploadFile(rawFileStore, originalFile, name)
+        finally:
+            rawFileStore.close()
+        return originalFile, ""
+
+    namespace = NSCREATED + "/omero/export_scripts/Make_Movie"
+    fileAnnotation, annMessage = scriptUtil.createLinkFileAnnotation(
+        conn, path, parent, output="Movie", ns=namespace,
+        mimetype=mimetype)
+    return fileAnnotation._obj, annMessage
+
+
+def writeMovie(commandArgs, conn):
+    """
+    Makes a movie of each image, or of each image in the datasets.
+
+    @ returns        Returns the file annotation
+    """
+    log("Movie created by OMERO")
+    log("")
 
+    message = ""
+
+    # Get the images
+    objects, logMessage = scriptUtil.getObjects(conn, commandArgs)
+    message += logMessage
+    if not objects:
+        return None, message
+    if commandArgs["Data_Type"] == "Dataset":
+        images = []
+        for ds in objects:
+            images.extend(list(ds.listChildren()))
+        if not images:
+            return None, message + "No images found in Datasets. "
+    else:
+        images = objects
+
+    format = commandArgs["Format"]
     ext = formatMap[format]
+    mimetype = formatMimetypes[format]
     movieName = "Movie"
     if "Movie_Name" in commandArgs:
         movieName = commandArgs["Movie_Name"]
@@ -626,28 +1264,81 @@ def writeMovie(commandArgs, conn):
 
     # spaces etc in file name cause problems
     movieName = re.sub("[$&\;|\(\)<>' ]", "", movieName)
-    framesPerSec = 2
-    if "FPS" in commandArgs:
-        framesPerSec = commandArgs["FPS"]
-    output = "localfile.%s" % ext
-    buildAVI(mw, mh, filelist, framesPerSec, output, format)
-    mimetype = formatMimetypes[format]
 
-    if not os.path.exists(output):
-        print "mencoder Failed to create movie file: %s" % output
-        return None, "Failed to create movie file: %s" % output
-    if not commandArgs["Do_Link"]:
-        originalFile = scriptUtil.createFile(
-            updateService, output, mimetype, movieName)
-        scriptUtil.uploadFile(rawFileStore, originalFile, movieName)
-        return originalFile, message
+    if len(images) == 1:
+        outputs = ["localfile.%s" % ext]
+    else:
+        baseName = movieName[:-len(ext)-1]
+        outputs = ["%s_%s.%s" % (baseName, image.getId(), ext)
+                   for image in images]
+
+    movieWorkers = 1
+    if "Parallel_Movies" in commandArgs:
+        movieWorkers = max(1, commandArgs["Parallel_Movies"])
+    assets = MovieAssets(conn)
+    cache = None
+    if "Frame_Cache_MB" in commandArgs and commandArgs["Frame_Cache_MB"] > 0:
+        cache = FrameCache(FRAME_CACHE_DIR,
+                           commandArgs["Frame_Cache_MB"] * 1024 * 1024)
+
+    # the rendering def belongs to one image: the others use their own
+    rdefImageId = None
+    if commandArgs["RenderingDef_ID"] >= 0:
+        rdefImageId = getRenderingDefImageId(conn,
+                                             commandArgs["RenderingDef_ID"])
+        if rdefImageId is None:
+            log("Rendering Def %s not found" % commandArgs["RenderingDef_ID"])
+
+    def run(i):
+        args = commandArgs
+        if args["RenderingDef_ID"] >= 0 and images[i].getId() != rdefImageId:
+            args = dict(commandArgs, RenderingDef_ID=-1)
+        return makeMovie(conn, images[i], args, assets, outputs[i], cache)
+
+    pool = ThreadPool(min(movieWorkers, len(images)))
+    try:
+        results = pool.map(run, range(len(images)))
+    finally:
+        pool.close()
+        pool.join()
+        assets.close()
+
+    movies = []
+    for image, (output, movieMessage) in zip(images, results):
+        message += movieMessage
+        if output is not None:
+            movies.append((image, output))
+    if not movies:
+        return None, message
 
-    namespace = NSCREATED + "/omero/export_scripts/Make_Movie"
-    fileAnnotation, annMessage = scriptUtil.createLinkFileAnnotation(
-        conn, output, omeroImage, output="Movie", ns=namespace,
-        mimetype=mimetype)
-    message += annMessage
-    return fileAnnotation._obj, message
+    doLink = commandArgs["Do_Link"]
+    if len(images) == 1:
+        image, output = movies[0]
+        fileObj, annMessage = uploadMovie(conn, output, movieName, image,
+                                          mimetype, doLink)
+        return fileObj, message + annMessage
+
+    if "Zip_Movies" in commandArgs and commandArgs["Zip_Movies"]:
+        zipName = "%s.zip" % movieName[:-len(ext)-1]
+        movieZip = zipfile.ZipFile(zipName, 'w', zipfile.ZIP_STORED, True)
+        try:
+            for image, output in movies:
+                movieZip.write(output)
+                os.remove(output)
+        finally:
+            movieZip.close()
+        fileObj, annMessage = uploadMovie(conn, zipName, zipName, objects[0],
+                                          "application/zip", doLink)
+        message += annMessage
+    else:
+        fileObj = None
+        for image, output in movies:
+            obj, annMessage = uploadMovie(conn, output, output, image,
+                                          mimetype, doLink)
+            if fileObj is None:
+                fileObj = obj
+    message += "Created %s of %s movies. " % (len(movies), len(images))
+    return fileObj, message
 
 
 def runAsScript():
@@ -663,7 +1354,9 @@ def runAsScript():
     ckeys = ckeys
     ckeys.sort()
     cOptions = wrap(ckeys)
-    dataTypes = [rstring("Image")]
+    dataTypes = [rstring("Image"), rstring("Dataset")]
+    projections = [rstring(NO_PROJECTION)] + \
+        [rstring(p) for p in sorted(PROJECTIONS.keys())]
 
     client = scripts.client(
         'Make_Movie',
@@ -672,21 +1365,30 @@ def runAsScript():
 
         scripts.String(
             "Data_Type", optional=False, grouping="1",
-            description="Choose Images via their 'Image' IDs.",
+            description="Choose Images via their 'Image' IDs, or all the"
+            " Images in Datasets via their 'Dataset' IDs.",
             values=dataTypes, default="Image"),
 
         scripts.List(
             "IDs", optional=False, grouping="1",
-            description="List of Image IDs to process.").ofType(rlong(0)),
+            description="List of Image or Dataset IDs to process. One movie"
+            " is made for each Image.").ofType(rlong(0)),
 
         scripts.Long(
             "RenderingDef_ID",
-            description="The Rendering Definitions for the Image.",
+            description="The Rendering Definitions for the Image. Only used"
+            " for the Image it belongs to.",
             default=-1, optional=True, grouping="1"),
 
         scripts.String(
             "Movie_Name", description="The name of the movie", grouping="2"),
 
+        scripts.Bool(
+            "Zip_Movies", grouping="2.1",
+            description="When making more than one movie, upload them in"
+            " one zip file instead of attaching each movie to its Image.",
+            default=False),
+
         scripts.Int(
             "Z_Start",
             description="Projection range (if not specified, use defaultZ"
@@ -697,6 +1399,13 @@ def runAsScript():
             description="Projection range (if not specified or, use defaultZ"
             " only - no projection)", min=0, grouping="3.2"),
 
+        scripts.String(
+            "Z_Projection", grouping="3.3",
+            description="Make one frame for each time-point, projecting the"
+            " planes from Z_Start to Z_End on the server. 'None' makes a"
+            " frame for each plane.", values=projections,
+            default=NO_PROJECTION),
+
         scripts.Int(
             "T_Start",
             description="The first time-point", min=0, default=0,
@@ -757,11 +1466,54 @@ def runAsScript():
             "Min_Height",
             description="Minimum height for output movie.", default=-1),
 
+        scripts.Int(
+            "X", grouping="14.1",
+            description="Left edge of the region to make the movie of."
+            " Default is the whole plane.", min=0),
+
+        scripts.Int(
+            "Y", grouping="14.2",
+            description="Top edge of the region to make the movie of.",
+            min=0),
+
+        scripts.Int(
+            "Width", grouping="14.3",
+            description="Width of the region to make the movie of.", min=1),
+
+        scripts.Int(
+            "Height", grouping="14.4",
+            description="Height of the region to make the movie of.", min=1),
+
+        scripts.Int(
+            "Max_Size", grouping="14.5",
+            description="Largest width or height of the movie, before"
+            " padding to the minimum size. Bigger images are scaled down,"
+            " rendering from a smaller resolution level of big images.",
+            min=16),
+
         scripts.Map(
             "Plane_Map",
             description="Specify the individual planes (instead of using"
             " T_Start, T_End, Z_Start and Z_End)", grouping="12"),
 
+        scripts.Int(
+            "Parallel_Renders", grouping="13",
+            description="Number of frames to render at the same time, each"
+            " with its own rendering engine. 1 renders one frame at a time.",
+            default=1, min=1, max=8),
+
+        scripts.Int(
+            "Parallel_Movies", grouping="13.1",
+            description="Number of movies to make at the same time when"
+            " making more than one.", default=1, min=1, max=8),
+
+        scripts.Int(
+            "Frame_Cache_MB", grouping="13.2",
+            description="Keep up to this many MB of rendered planes on the"
+            " server between runs, so that making the movie again with"
+            " different overlays, slides or frame rate doesn't render the"
+            " planes again. 0 turns the cache off.", default=0, min=0),
+
         scripts.Object(
             "Watermark",
             description="Specifiy a watermark as an Original File (png or"